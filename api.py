@@ -0,0 +1,220 @@
+import re
+import random
+import logging
+import importlib.util
+
+from urllib.parse import urlencode
+
+from instagrapi import config
+from instagrapi.exceptions import ClientError, LoginRequired, PleaseWaitFewMinutes
+from instagrapi.utils import dumps, generate_signature
+
+# Optional, replies go through instagrapi in a thread pool without it
+# Only looked up here, it is imported when the first request goes out
+HTTPX_INSTALLED = importlib.util.find_spec("httpx") is not None
+
+
+def shared_transport(max_connections=16):
+	"""Connection pool to hand to several AsyncPrivateAPI, None without httpx"""
+	if not HTTPX_INSTALLED:
+		return None
+
+	import httpx
+	return httpx.AsyncHTTPTransport(limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections))
+
+
+class AsyncPrivateAPI(object):
+	"""asyncio version of the few private API endpoints the bot calls on every
+	push, sent over a keep-alive connection pool instead of instagrapi's
+	blocking requests session.
+
+	Headers and authorization are taken from the logged in instagrapi `client`
+	on each request, and both clients use the cookie jar of its requests
+	session, so its session stays the single source of truth.
+
+	Accounts run side by side pass the same `transport` to share its
+	connection pool, it is left open by close(). Accounts behind a proxy
+	always get a pool of their own.
+	"""
+
+	available = HTTPX_INSTALLED
+
+	def __init__(self, client, max_connections=4, timeout=25.0, transport=None):
+		self.client = client
+		self.max_connections = max_connections
+		self.timeout = timeout
+		self.transport = transport
+
+		self.requests = 0
+		self.errors = 0
+
+		self._http = None
+
+	def _session(self):
+		# Created on first use, it has to be bound to the running loop
+		if self._http is None:
+			import httpx
+
+			proxies = self.client.private.proxies or {}
+			proxy = proxies.get('https') or proxies.get('http')
+			if self.transport is not None and not proxy:
+				self._http = httpx.AsyncClient(timeout=self.timeout, transport=self.transport)
+			else:
+				self.transport = None
+				self._http = httpx.AsyncClient(
+					timeout=self.timeout,
+					proxy=proxy,
+					limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+				)
+			# Shared, not copied: httpx.Cookies(jar) would copy it
+			self._http.cookies.jar = self.client.private.cookies
+		return self._http
+
+	def _headers(self):
+		headers = dict(self.client.private.headers)
+		headers.update(self.client.base_headers)
+		headers['Authorization'] = self.client.authorization
+		# requests skips headers set to None, httpx refuses them
+		return {name: value for name, value in headers.items() if value is not None}
+
+	async def request(self, endpoint, data=None, params=None, with_signature=True):
+		url = f"https://{config.API_DOMAIN}/api/v1/{endpoint}"
+		headers = self._headers()
+
+		self.requests += 1
+		if data is not None:
+			headers['Content-Type'] = "application/x-www-form-urlencoded; charset=UTF-8"
+			body = generate_signature(dumps(data)) if with_signature else urlencode(data)
+			response = await self._session().post(url, content=body, params=params, headers=headers)
+		else:
+			headers.pop('Content-Type', None)
+			response = await self._session().get(url, params=params, headers=headers)
+
+		mid = response.headers.get('ig-set-x-mid')
+		if mid:
+			self.client.mid = mid
+
+		try:
+			result = response.json()
+		except ValueError:
+			result = {}
+
+		if response.is_error or result.get('status') == 'fail':
+			self.errors += 1
+			message = result.get('message') or response.text[:256]
+			logging.debug(f"{endpoint} {response.status_code}: {result}")
+
+			if "Please wait a few minutes" in message:
+				raise PleaseWaitFewMinutes(message, response=response)
+			if message == "login_required":
+				raise LoginRequired(message, response=response)
+			raise ClientError(message, response=response)
+
+		return result
+
+	async def register_push(self, token):
+		return await self.request("push/register/", data=dict(
+			device_type="android_mqtt",
+			is_main_push_channel=True,
+			phone_id=self.client.phone_id,
+			device_token=token,  # fbns_token
+			guid=self.client.uuid,
+			users=self.client.user_id,
+		), with_signature=False)
+
+	async def direct_send(self, text, thread_ids):
+		"""Text message to threads, same form as instagrapi's direct_send, returns the raw payload"""
+		token = self.client.generate_mutation_token()
+		data = {
+			"action": "send_item",
+			"is_x_transport_forward": "false",
+			"send_silently": "false",
+			"is_shh_mode": "0",
+			"send_attribution": "message_button",
+			"client_context": token,
+			"device_id": self.client.android_device_id,
+			"mutation_token": token,
+			"_uuid": self.client.uuid,
+			"btt_dual_send": "false",
+			"is_ae_dual_send": "false",
+			"offline_threading_id": token,
+			"thread_ids": dumps([int(thread_id) for thread_id in thread_ids]),
+		}
+		method = "text"
+		if "http" in text:
+			method = "link"
+			data["link_text"] = text
+			data["link_urls"] = dumps(re.findall(r"(https?://[^\s]+)", text))
+		else:
+			data["text"] = text
+
+		result = await self.request(f"direct_v2/threads/broadcast/{method}/", data=self.client.with_default_data(data), with_signature=False)
+		return result.get("payload")
+
+	async def direct_thread(self, thread_id, limit=20):
+		"""Raw thread dict with its `limit` latest items"""
+		result = await self.request(f"direct_v2/threads/{thread_id}/", params={
+			"visual_message_return_type": "unseen",
+			"direction": "older",
+			"limit": str(limit),
+		})
+		return result["thread"]
+
+	async def direct_pending_threads(self):
+		"""Ids of the threads in the pending inbox, latest page"""
+		result = await self.request("direct_v2/pending_inbox/", params={
+			"visual_message_return_type": "unseen",
+			"persistentBadging": "true",
+			"is_prefetching": "false",
+		})
+		return [thread["thread_id"] for thread in result.get("inbox", {}).get("threads", [])]
+
+	async def direct_approve_threads(self, thread_ids):
+		"""Accept several message requests in one call"""
+		return await self.request("direct_v2/threads/approve_multiple/", data={
+			"thread_ids": dumps([str(thread_id) for thread_id in thread_ids]),
+			"folder": "",
+			"_uuid": self.client.uuid,
+		}, with_signature=False)
+
+	async def media_comments(self, media_id):
+		"""Latest page of comments of a media as [{"pk", "text", "user_id"}, ..]"""
+		result = await self.request(f"media/{media_id}/comments/", params={"can_support_threading": "true"})
+		return [
+			{"pk": comment["pk"], "text": comment.get("text", ""), "user_id": comment.get("user_id") or comment["user"]["pk"]}
+			for comment in result.get("comments", [])
+		]
+
+	async def media_comment(self, media_id, text, replied_to_comment_id=None):
+		token = self.client.generate_uuid()
+		data = {
+			"delivery_class": "organic",
+			"feed_position": str(random.randint(0, 6)),
+			"container_module": "feed_timeline",
+			"media_id": media_id,
+			"_uid": str(self.client.user_id),
+			"tap_source": "button",
+			"user_breadcrumb": self.client.gen_user_breadcrumb(len(text)),
+			"idempotence_token": token,
+			"comment_creation_key": token,
+			"comment_text": text,
+		}
+		if replied_to_comment_id:
+			data["replied_to_comment_id"] = int(replied_to_comment_id)
+
+		result = await self.request(f"media/{media_id}/comment/", data=self.client.with_action_data(data))
+		return result.get("comment")
+
+	async def close(self):
+		if self._http is not None:
+			if self.transport is None:
+				# Closing the client would close a shared transport too
+				await self._http.aclose()
+			self._http = None
+
+	@property
+	def metrics(self):
+		return {
+			"api_requests": self.requests,
+			"api_errors": self.errors
+		}
@@ -2,21 +2,36 @@ import os
 import re
 import json
 import time
-import pickle
 import random
 import asyncio
 import logging
+import threading
+
+STARTED = time.perf_counter()
 
-from pathlib import Path
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 from instagrapi import Client
+from requests.adapters import HTTPAdapter
 
 from fbns_mqtt import fbns_mqtt
+from fbns_mqtt.state import FBNSState, atomic_write
+from fbns_mqtt.supervisor import ConnectionSupervisor
+from fbns_mqtt.metrics import REGISTRY, serve as serve_metrics
 from notifications import InstagramNotification
+from puns import PunIndex
+from prefs import PreferenceStore, PreferenceResolver
+from sender import ReplySender, PUN, COMMAND, WELCOME, DEBUG, call
+from comments import CommentReplier, preview_text
+from pending import PendingSweeper
+from commands import CommandRegistry
+from api import AsyncPrivateAPI
+from dedup import DedupWindow
+
+IMPORTED = time.perf_counter()
 
 
-if not "sessions" in os.listdir(): os.mkdir("sessions")
+os.makedirs(os.path.join(os.path.abspath(os.path.dirname(__file__)), "sessions"), exist_ok=True)
 
 load_dotenv()
 
@@ -28,8 +43,29 @@ logging.basicConfig(
 
 
 STOP = asyncio.Event()
+# Pushes with another collapse key are dropped as soon as they come in
+COMMENT_COLLAPSE_KEYS = frozenset({
+	'comment', 'mentioned_comment', 'comment_subscribed', 'comment_subscribed_on_like', 'reply_to_comment_with_threading'
+})
+HANDLED_COLLAPSE_KEYS = frozenset({'direct_v2_message'}) | COMMENT_COLLAPSE_KEYS
+PUNS = PunIndex(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'puns.json'))
+REGISTRY.add_collector(lambda: {f"qfbot_puns_{k}": v for k, v in PUNS.metrics.items()})
+
+NOTIFICATIONS = REGISTRY.counter('qfbot_notifications_total', 'Notifications handled, by collapse key and category', ('collapse_key', 'push_category'))
+MATCHES = REGISTRY.counter('qfbot_pun_matches_total', 'Messages a pun was found for, by language', ('lang',))
+HANDLE_SECONDS = REGISTRY.histogram('qfbot_handle_seconds', 'Time spent in on_fbns_message')
+MATCH_SECONDS = REGISTRY.histogram('qfbot_match_seconds', 'Time to find the pun of a message')
 
 class ExtendedClient(Client):
+	def __init__(self, *args, **kwargs):
+		# private_request returns the shared last_json, one blocking request at a time per account
+		self._request_lock = threading.RLock()
+		super().__init__(*args, **kwargs)
+
+	def private_request(self, *args, **kwargs):
+		with self._request_lock:
+			return super().private_request(*args, **kwargs)
+
 	def register_push(self, token):
 		endpoint = "push/register/"
 		params = dict(
@@ -44,97 +80,360 @@ class ExtendedClient(Client):
 		res = self.private_request(endpoint, data=params, with_signature=False)
 		return res
 
+	def share_http_adapters(self, adapters):
+		"""Mount the {"private": .., "public": ..} adapters shared by several accounts"""
+		for name, session in (('private', self.private), ('public', self.public)):
+			mounted = session.get_adapter('https://')
+			if type(mounted) is not HTTPAdapter:
+				# curl transport, it pools its own connections
+				continue
+
+			adapter = adapters[name]
+			# Keep the retry and backoff policy instagrapi mounted with its own adapter
+			adapter.max_retries = mounted.max_retries
+			session.mount('https://', adapter)
+
 
 class InstagramMQTT(ExtendedClient):
-	def __init__(self, username, password):
+	def __init__(self, username, password, settings_path='settings.json', stop=None, executor=None, http_adapters=None, http_transport=None):
+		self.username = username
+		self.settings_path = self.get_abs_path(settings_path)
+		self.stop_event = stop or STOP
+
+		start = time.perf_counter()
+		self.startup = {"imports": IMPORTED - STARTED}
+
+		self.init_pipeline(username, executor, http_transport=http_transport)
+		self.startup["pipeline"] = time.perf_counter() - start
+
 		session = {}
-		self.Psettings = {}
-		if os.path.exists('settings.json'):
-			self.Psettings = json.load(open('settings.json'))
-			session = self.Psettings['api_settings']
+		if os.path.exists(self.settings_path):
+			with open(self.settings_path) as f:
+				saved = json.load(f)
+			if 'api_settings' in saved:
+				session = saved.pop('api_settings')
+				# Language preferences used to live next to api_settings, move them over
+				langs = {key: value for key, value in saved.items() if isinstance(value, str) and value in self.puns}
+				if langs:
+					self.prefs.update(langs)
+					self.prefs.flush()
+			else:
+				# Older files hold the instagrapi settings at the top level
+				session = saved
 
 		super().__init__(session)
-		self.login(username, password)
+		if http_adapters:
+			# Accounts run side by side can share one connection pool
+			self.share_http_adapters(http_adapters)
+		self.startup["settings"] = time.perf_counter() - start - self.startup["pipeline"]
+
+		start = time.perf_counter()
+		if self.user_id:
+			# Saved session, reused as is. login() would block on an account_info() call to check it,
+			# validate_session() does that in the background once FBNS is connecting
+			self.username, self.password = username, password
+			self.session_checked = False
+		else:
+			self.login(username, password)
+			self.save_settings()
+			self.session_checked = True
+		self.startup["login"] = time.perf_counter() - start
+
+	def init_pipeline(self, username, executor=None, sessions_dir="sessions", http_transport=None):
+		"""Everything on_fbns_message needs, apart from the Instagram session"""
+		sessions_dir = self.get_abs_path(sessions_dir)
+
+		self.prefs = PreferenceStore(os.path.join(sessions_dir, f"{username}_prefs.db"))
+		self.langs = PreferenceResolver(self.prefs, default="fr", size=int(os.getenv("lang-cache-size") or 4096))
+
+		self.fbns_state = FBNSState(os.path.join(sessions_dir, f"{username}_fbns.json"))
+
+		# FBNS redelivers buffered pushes after a reconnect, they must not be answered twice
+		self.dedup = DedupWindow(
+			capacity=int(os.getenv("dedup-size") or 4096),
+			ttl=float(os.getenv("dedup-ttl") or 3600)
+		)
+		self.dedup_file = os.path.join(sessions_dir, f"{username}_dedup.json")
+		self.pushes = 0
+
+		workers = int(os.getenv("reply-workers") or 4)
+
+		# Replies and push registration go over a pooled async HTTP client when httpx is installed
+		self.api = AsyncPrivateAPI(self, max_connections=workers, transport=http_transport) if AsyncPrivateAPI.available else None
+
+		# Replies are sent from a worker pool, never from the MQTT callback itself
+		self.sender = ReplySender(
+			self.api.direct_send if self.api else self.direct_send,
+			workers=workers,
+			max_queue=int(os.getenv("reply-queue-size") or 256),
+			rate=float(os.getenv("send-rate") or 0.5),
+			burst=int(os.getenv("send-burst") or 5),
+			thread_interval=float(os.getenv("thread-interval") or 1.0),
+			coalesce_window=float(os.getenv("coalesce-window") or 0.3),
+			max_age=float(os.getenv("reply-max-age") or 10.0),
+			deadlines={
+				COMMAND: float(os.getenv("command-max-age") or 60.0),
+				WELCOME: float(os.getenv("welcome-max-age") or 600.0)
+			},
+			executor=executor
+		)
+
+		# Slash commands, looked up by name instead of one branch per command
+		self.commands = CommandRegistry(self.reply)
+		self.commands.register(
+			"setlang", self.setlang, min_args=1, usage="/setlang <language>",
+			cooldown=float(os.getenv("command-cooldown") or 2.0)
+		)
 
-		self.settings_file = Path(f"sessions/{username}_mqtt.pkl")
+		# Comments get a worker and a send budget of their own, DMs never wait behind them
+		self.comments = CommentReplier(
+			self.api.media_comments if self.api else self.fetch_comments,
+			self.api.media_comment if self.api else self.media_comment,
+			self.comment_reply,
+			rate=float(os.getenv("comment-rate") or 0.1),
+			burst=int(os.getenv("comment-burst") or 2),
+			batch_window=float(os.getenv("comment-batch-window") or 2.0),
+			cache_ttl=float(os.getenv("comment-cache-ttl") or 30.0)
+		)
+
+		# Message requests are approved in batches by a background sweep, not one call per push
+		self.pending = PendingSweeper(
+			self.api.direct_pending_threads if self.api else self.pending_thread_ids,
+			self.api.direct_approve_threads if self.api else self.approve_threads,
+			lambda thread_id: self.reply("Hey! I am now activated, have fun!", thread_id, WELCOME),
+			interval=float(os.getenv("pending-sweep-interval") or 300),
+			welcome_rate=float(os.getenv("welcome-rate") or 0.05),
+			executor=self.sender.executor
+		)
 
 	def save_settings(self):
-		with open(self.get_abs_path('settings.json'), 'w') as f:
-			json.dump(self.get_settings(), f, indent=2)
+		# Written next to the file then swapped in, a crash never leaves a truncated settings.json
+		data = json.dumps({'api_settings': self.get_settings()}, indent=2, default=str)
+		atomic_write(self.settings_path, data.encode('utf8'))
 
-	def save_fbns_settings(self, data):
-		with open(self.settings_file, 'wb') as f:
-			pickle.dump(data, f)
+	def save_fbns_settings(self):
+		# Only written when the auth or token actually changed
+		self.fbns_state.save()
 	
 	def get_abs_path(self, x):
 		absp = os.path.abspath(os.path.join(os.path.abspath(os.path.dirname(__file__)), x))
 
 		return absp
 
-	def handle_disconnect(self, packet, exc=None):
-		# Reconnect
-		asyncio.ensure_future(self.reconnect_after_disconnect())
-
-	async def reconnect_after_disconnect(self):
-		logging.warning('Disconnected.. Reconnecting')
+	def load_fbns_settings(self):
+		return self.fbns_state.load()
 
-		await self.listener_worker()
-
-	async def listener_worker(self):
-		if os.path.exists(self.get_abs_path(self.settings_file)):
-			with open(self.get_abs_path(self.settings_file), 'rb') as f:
-				self.settings = pickle.load(f)
-		else:
-			self.settings = {}
-
-		self.client = fbns_mqtt.FBNSMQTTClient() 
-		self.client.on_disconnect = self.handle_disconnect
+	@property
+	def fbns_settings(self):
+		# Not instagrapi's Client.settings, its setters write their own keys in there
+		return self.fbns_state.data
 
-		fbns_auth = self.settings.get('fbns_auth')
-		if fbns_auth:
-			self.client.set_fbns_auth(fbns_mqtt.FBNSAuth(fbns_auth))
+	def create_client(self):
+		client = fbns_mqtt.FBNSMQTTClient()
+		client.collapse_keys = HANDLED_COLLAPSE_KEYS
 
-		self.client.on_fbns_auth = self.on_fbns_auth
-		self.client.on_fbns_token = self.on_fbns_token
-		self.client.on_fbns_message = self.on_fbns_message
+		# Auth is read once and reused across reconnects, on_fbns_auth drops it when a new one comes in
+		if self.fbns_auth is None and self.fbns_settings.get('fbns_auth'):
+			self.fbns_auth = fbns_mqtt.FBNSAuth(self.fbns_settings['fbns_auth'])
+		if self.fbns_auth:
+			client.set_fbns_auth(self.fbns_auth)
 
-		await self.client.connect('mqtt-mini.facebook.com', 443, ssl=True, keepalive=900)
-		await STOP.wait()
-		await self.client.disconnect()
+		client.on_fbns_auth = self.on_fbns_auth
+		client.on_fbns_token = self.on_fbns_token
+		client.on_fbns_message = self.on_fbns_message
 
-	def on_login_callback(self, client):
-		self.settings['api_settings'] = client.settings
 		self.client = client
+		return client
 
-		self.save_fbns_settings(self.settings)
+	async def listener_worker(self):
+		self.load_fbns_settings()
+		self.fbns_auth = None
+		self.dedup.load(self.dedup_file)
+		self.supervisor = ConnectionSupervisor(self.create_client, 'mqtt-mini.facebook.com', 443, ssl=True, keepalive=900)
+
+		# Per account gauges, labelled so accounts run side by side can be told apart
+		collector = REGISTRY.add_collector(lambda: (
+			{f"qfbot_{k}": v for k, v in self.metrics.items()}, {"account": self.username}
+		))
+
+		self.sender.start()
+		self.comments.start()
+		flusher = asyncio.ensure_future(self.prefs.run_flusher(self.stop_event))
+		sweeper = asyncio.ensure_future(self.pending.run(self.stop_event))
+		startup = asyncio.ensure_future(self.log_startup())
+		if not self.session_checked:
+			asyncio.ensure_future(self.validate_session())
+
+		try:
+			await self.supervisor.run(self.stop_event)
+			# Sweeps and comments can still queue replies, the sender goes last
+			await sweeper
+			await self.comments.stop()
+			await self.sender.stop()
+			await flusher
+			self.dedup.save(self.dedup_file)
+			if self.api:
+				await self.api.close()
+		finally:
+			startup.cancel()
+			REGISTRY.remove_collector(collector)
+
+	async def validate_session(self):
+		# Checks the saved session and logs in again if it was revoked
+		try:
+			await asyncio.get_event_loop().run_in_executor(self.sender.executor, self.login, self.username, self.password)
+		except Exception as e:
+			logging.error(f"[{self.username}] Could not log in: {e!r}")
+			return
+
+		self.session_checked = True
+		self.save_settings()
+
+	async def log_startup(self):
+		start = time.perf_counter()
+		await self.supervisor.connected.wait()
+		self.startup["fbns_connect"] = time.perf_counter() - start
+
+		phases = ', '.join(f"{name} {seconds*1000:.0f}ms" for name, seconds in self.startup.items())
+		session = "saved session" if not self.session_checked else "logged in"
+		logging.info(f"[{self.username}] Ready in {time.perf_counter() - STARTED:.2f}s ({session}): {phases}")
+
+	@property
+	def metrics(self):
+		metrics = {"pushes": self.pushes}
+		metrics.update(self.sender.metrics)
+		metrics.update(self.commands.metrics)
+		metrics.update(self.comments.metrics)
+		metrics.update(self.pending.metrics)
+		metrics.update(self.prefs.metrics)
+		metrics.update(self.langs.metrics)
+		metrics.update(self.dedup.metrics)
+		if self.api:
+			metrics.update(self.api.metrics)
+		if getattr(self, "supervisor", None):
+			metrics.update(self.supervisor.metrics)
+		if getattr(self, "client", None):
+			metrics["rejected_pushes"] = self.client.rejected_pushes
+		return metrics
+
+	def reply(self, text, thread_id, priority=PUN):
+		return self.sender.submit(text, thread_id, priority)
+
+	async def debug_thread(self, thread_id):
+		# Lowest priority, takes a token only when no reply is waiting for one
+		try:
+			await asyncio.wait_for(self.sender.bucket.acquire(DEBUG), self.sender.deadlines[DEBUG])
+			thread = await call(self.sender.executor, self.api.direct_thread if self.api else self.direct_thread, thread_id)
+		except asyncio.TimeoutError:
+			return
+		except Exception as e:
+			logging.debug(f"Could not fetch thread {thread_id}: {e!r}")
+			return
+
+		logging.debug(f"Thread {thread_id}: {thread}")
+
+	def setlang(self, command):
+		lang = command.args[0].lower()
+		if lang not in self.puns.keys():
+			return "This language is not yet supported.. Help to support it here: https://github.com/ghrlt/qfbot"
+
+		if command.network_classification == "in_network_canonical_thread": # PM
+			self.langs.set(command.user_id, lang)
+			return f"You successfully set your default language to {lang.upper()}!"
+
+		elif command.is_group: # Group DM
+			self.langs.set(command.thread_id, lang)
+			return f"You successfully set chat default language to {lang.upper()}!"
+
+		logging.warning(f"/setlang from {command.username} in a {command.network_classification} thread")
+
+	def pending_thread_ids(self):
+		# Blocking fallbacks of AsyncPrivateAPI.direct_pending_threads/direct_approve_threads
+		threads, _ = self.direct_pending_chunk()
+		return [thread.id for thread in threads]
+
+	def approve_threads(self, thread_ids):
+		return self.private_request("direct_v2/threads/approve_multiple/", data={
+			"thread_ids": json.dumps([str(thread_id) for thread_id in thread_ids]),
+			"folder": "",
+			"_uuid": self.uuid,
+		}, with_signature=False)
+
+	def fetch_comments(self, media_id):
+		# Blocking fallback of AsyncPrivateAPI.media_comments
+		return [{"pk": c.pk, "text": c.text, "user_id": c.user.pk} for c in self.media_comments(media_id, amount=20)]
+
+	def comment_reply(self, request):
+		if str(request.user_id) == str(self.user_id):
+			return None # Our own replies come back as pushes too
+
+		lang = self.langs.resolve(request.media_id, request.user_id)
+		found = PUNS.match(lang, request.text)
+		if found:
+			MATCHES.inc(lang)
+			return f"@{request.username} {random.choice(found[1])}"
 
 	def on_fbns_auth(self, auth):
-		self.settings['fbns_auth'] = auth
-		self.settings['fbns_auth_received'] = datetime.now()
+		if self.fbns_settings.get('fbns_auth') == auth:
+			# Same auth as the one we connected with, nothing to save
+			return
+
+		self.fbns_settings['fbns_auth'] = auth
+		self.fbns_auth = None
+		self.fbns_settings['fbns_auth_received'] = datetime.now()
 		
-		self.save_fbns_settings(self.settings)
+		self.save_fbns_settings()
 
 	def on_fbns_token(self, token):
-		device_id = self.settings.get('device_id')
-
-		if self.settings.get('fbns_token') == token:
-			if "fbns_token_received" in self.settings:
-				if self.settings['fbns_token_received'] > datetime.now()-timedelta(hours=24):
+		if self.fbns_settings.get('fbns_token') == token:
+			if "fbns_token_received" in self.fbns_settings:
+				if self.fbns_settings['fbns_token_received'] > datetime.now()-timedelta(hours=24):
 					# Do not register token twice in 24 hours
 					return
 
-		self.register_push(token)
+		# Registering is a network call, the MQTT callback must not wait for it
+		asyncio.ensure_future(self.register_token(token))
+
+	async def register_token(self, token):
+		try:
+			await call(self.sender.executor, self.api.register_push if self.api else self.register_push, token)
+		except Exception as e:
+			logging.error(f"Could not register push token: {e!r}")
+			return
 
-		self.settings['fbns_token'] = token
-		self.settings['fbns_token_received'] = datetime.now()
-		self.save_fbns_settings(self.settings)
+		self.fbns_settings['fbns_token'] = token
+		self.fbns_settings['fbns_token_received'] = datetime.now()
+		self.save_fbns_settings()
 
 	def on_fbns_message(self, push):
+		start = time.perf_counter()
+		try:
+			self.handle_push(push)
+		finally:
+			HANDLE_SECONDS.observe(time.perf_counter() - start)
+
+	def handle_push(self, push):
+		self.pushes += 1
+
 		if push.payload:
 			notification = InstagramNotification(push.payload)
+
+			if self.dedup.seen(push.notificationId or notification.pushId):
+				return
+
+			NOTIFICATIONS.inc(notification.collapseKey, notification.pushCategory)
 			
-			if notification.collapseKey == 'comment':
-				pass # TODO
+			if notification.collapseKey in COMMENT_COLLAPSE_KEYS:
+				params = notification.actionParams or {}
+				media_id = params.get('media_id') or params.get('id')
+				if media_id and notification.message:
+					self.comments.submit(
+						media_id,
+						params.get('target_comment_id') or params.get('forced_preview_comment_id'),
+						notification.sourceUserId,
+						notification.message.split(' ')[0],
+						preview_text(notification.message)
+					)
 			
 			elif notification.collapseKey == 'direct_v2_message':
 				if notification.pushCategory == "direct_v2_text":
@@ -146,76 +445,34 @@ class InstagramMQTT(ExtendedClient):
 
 					msg_thread_id = notification.actionParams['id']
 
-					msg_content = ':'.join(notification.message.split(':')[1:])[1:] # last [1:] remove the leading space
+					message = notification.message or ''
+					msg_content = ':'.join(message.split(':')[1:])[1:] # last [1:] remove the leading space
 					msg_author = {
-						"name": notification.message.split(':')[0].split(' ')[0],
+						"name": message.split(':')[0].split(' ')[0],
 						"id": notification.sourceUserId
 					}
 
-					if msg_content[0] == "/": # Might be a cmd
-						if msg_content.split(' ')[0][1:] == "setlang":
-							arg = msg_content.split(' ')[1].lower()
-							if arg in self.puns.keys():
-								stgs = self.Psettings
-
-								if notification.network_classification == "in_network_canonical_thread": # PM
-									stgs[msg_author['id']] = arg
-									msg = f"You successfully set your default language to {arg.upper()}!"
-
-								elif notification.network_classification == "in_network_group_thread": # Group DM
-									stgs[msg_thread_id] = arg
-									msg = f"You successfully set chat default language to {arg.upper()}!"
-
-								else:
-									print(msg_author, msg.network_classification)
-									return #wtf
-
-								self.save_settings()
-
-								self.direct_send(
-									msg,
-									thread_ids=[msg_thread_id]
-								)
-
-							else:
-								self.direct_send(
-									"This language is not yet supported.. Help to support it here: https://github.com/ghrlt/qfbot",
-									thread_ids=[msg_thread_id]
-								)
-
-							return
-
-					msg_content = msg_content.strip(',;:!?.(){}[]"*') #Punctuation is no more a problem
-
-					# Finding pun
-					start = msg_content.split(' ')[-1].lower()
+					if self.commands.dispatch(msg_content, msg_thread_id, msg_author['id'], msg_author['name'], notification.network_classification):
+						return
 
 					# Get lang of user/thread, default FR
-					lang = self.Psettings.get(msg_thread_id) or self.Psettings.get(msg_author['id']) or "fr"
+					lang = self.langs.resolve(msg_thread_id, msg_author['id'])
 
-					plang = self.puns.get(lang)
-					if plang: # If language supported
-						pwords = plang.get(start)
-						if pwords: # If a pun was found
-							end = random.choice(pwords)
+					# Finding pun, longest known word (or words) the message ends with
+					start = time.perf_counter()
+					found = PUNS.match(lang, msg_content)
+					MATCH_SECONDS.observe(time.perf_counter() - start)
+					if found: # If a pun was found
+						MATCHES.inc(lang)
+						start, pwords = found
+						end = random.choice(pwords)
 
-							self.direct_send(end, thread_ids=[msg_thread_id])
+						self.reply(end, msg_thread_id)
 
 					
 				elif notification.pushCategory == "direct_v2_pending":
-					msg_thread_id = notification.actionParams['id']
-					msg_author = {
-						"name": notification.message.split(':')[0],
-						"id": notification.sourceUserId
-					}
-
-
-					#thread = self.client.get_direct_thread(thread_id=msg_thread_id, max_messages=1)
-					#msg = thread['items'][0]
-					#msg_content = msg['text']
-
-
-					self.direct_send("Hey! I am now activated, have fun!", thread_ids=[msg_thread_id])
+					# Approved and welcomed by the next pending inbox sweep
+					self.pending.note(notification.actionParams['id'])
 
 
 				elif notification.pushCategory is None:
@@ -223,27 +480,67 @@ class InstagramMQTT(ExtendedClient):
 						pass
 
 				else:
-					print(notification)
-					print('---')
-					print(self.client.get_direct_thread(notification.actionParams['id']))
+					logging.debug(f"Unhandled push: {notification}")
+					thread_id = (notification.actionParams or {}).get('id')
+					if thread_id and logging.getLogger().isEnabledFor(logging.DEBUG):
+						# Never fetched inline, it would hold the pushes behind it
+						asyncio.ensure_future(self.debug_thread(thread_id))
 			else:
-				print(notification)
+				logging.debug(f"Unhandled push: {notification}")
 
 
 	@property
 	def puns(self):
-		with open('puns.json', 'r') as f:
-			puns = json.load(f)
-
-		return puns
+		return PUNS.table
 
 if __name__ == "__main__":
+	from runner import MultiAccountRunner, ProcessSupervisor, load_accounts
+	import profiler
+
 	loop = asyncio.get_event_loop()
 
-	username, password = os.getenv("ig-username"), os.getenv("ig-password")
-	app = InstagramMQTT(username or input("Username? "), password or input("Password? "))
+	accounts_file = os.getenv("accounts-file") or "accounts.json"
+	processes = int(os.getenv("processes") or 1)
+
+	# Prometheus endpoint, worker processes serve on the next ports (metrics-port+1, +2..)
+	metrics_port = int(os.getenv("metrics-port") or 0) or None
+
+	# kill -USR1 <pid> samples every thread for profile-seconds and writes a flamegraph ready file
+	# to profile-dir, the watchdog logs where the loop is stuck when it blocks for slow-callback-ms
+	profiling = dict(
+		directory=os.path.join(os.path.abspath(os.path.dirname(__file__)), os.getenv("profile-dir") or "profiles"),
+		duration=float(os.getenv("profile-seconds") or 30),
+		slow_threshold=float(os.getenv("slow-callback-ms") or 100) / 1000
+	)
+
+	if os.path.exists(accounts_file) and processes > 1:
+		# Accounts are spread over worker processes, this one only watches them
+		ProcessSupervisor(
+			InstagramMQTT, load_accounts(accounts_file), processes,
+			metrics_port=metrics_port, profiling=profiling
+		).run()
+		raise SystemExit
+
+	profiler.install(loop, **profiling)
+
+	if metrics_port:
+		loop.run_until_complete(serve_metrics(metrics_port))
+
+	if os.path.exists(accounts_file):
+		# Multi-account mode, every account of the file runs in this process
+		runner = MultiAccountRunner(
+			InstagramMQTT,
+			load_accounts(accounts_file),
+			workers=int(os.getenv("reply-workers") or 8)
+		)
+		main = runner.run(STOP)
+
+	else:
+		username, password = os.getenv("ig-username"), os.getenv("ig-password")
+		app = InstagramMQTT(username or input("Username? "), password or input("Password? "))
+		main = app.listener_worker()
 
 	try:
-		loop.run_until_complete(app.listener_worker())
+		loop.run_until_complete(main)
 	except asyncio.CancelledError:
 		pass
@@ -0,0 +1,60 @@
+"""Per-push decode cost: stdlib json + second parse of fbpushnotif (before) against fbns_mqtt.codec (after)
+
+    python benchmarks/decode.py [iterations]
+"""
+import os
+import sys
+import json
+import zlib
+import timeit
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from fbns_mqtt import codec
+
+
+def sample_push(text="mdr mais pourquoi"):
+    notification = {
+        "t": "", "m": f"bob: {text}", "tt": "", "ig": "direct_v2?id=340282366841710300949128171234567890123&x=29873429872349872349872",
+        "collapse_key": "direct_v2_message", "i": "https://instagram.fxxx1-1.fna.fbcdn.net/v/t51.2885-19/s150x150/1.jpg",
+        "a": "https://instagram.fxxx1-1.fna.fbcdn.net/v/t51.2885-19/s150x150/1.jpg", "sound": "default",
+        "pi": "b1f3a9c2d4e5f60718293a4b5c6d7e8f", "c": "direct_v2_text", "u": 1234567890, "s": "9876543210",
+        "igo": "direct_v2?id=340282366841710300949128171234567890123&x=29873429872349872349872&t=1",
+        "bc": json.dumps({"dt": 0, "ds": 1}), "ia": "", "SuppressBadge": "1", "badge": 2,
+        "network_classification": "in_network_group_thread", "push_phase": "direct", "time_to_live": 86400,
+    }
+    push = {
+        "token": "", "ck": 123456789012345, "pn": "com.instagram.android", "cp": "direct_v2_message",
+        "fbpushnotif": json.dumps(notification), "nid": "5a6b7c8d9e", "bu": "0",
+    }
+    return zlib.compress(json.dumps(push).encode('utf8'), level=9)
+
+
+def before(raw):
+    data = json.loads(zlib.decompress(raw))
+    data['fbpushnotif'] = json.loads(data['fbpushnotif'])
+    return data
+
+
+def after(raw):
+    return codec.decode_nested(codec.decode_payload(raw), 'fbpushnotif')
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    raw = sample_push()
+    assert before(raw) == after(raw)
+
+    print(f"payload: {len(raw)} bytes compressed, backend: {codec.BACKEND}")
+    results = {}
+    for name, fn in (("before (json)", before), (f"after ({codec.BACKEND})", after)):
+        best = min(timeit.repeat(lambda: fn(raw), number=n, repeat=5)) / n
+        results[name] = best
+        print(f"{name:>20}: {best*1e6:7.2f} us/push")
+
+    base, new = results.values()
+    print(f"{'speedup':>20}: {base/new:7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Sustained throughput and reconnect behaviour of the client stack against the local FBNS broker
+
+Runs fbns_mqtt.broker in process, connects a ConnectionSupervisor-managed FBNSMQTTClient
+feeding InstagramMQTT.on_fbns_message (replies counted, not sent) and drops every
+connection on a schedule.
+
+    python benchmarks/load.py [--rate 2000] [--duration 30] [--drop-every 10]
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from fbns_mqtt.broker import FBNSTestBroker
+from fbns_mqtt.supervisor import ConnectionSupervisor
+from pipeline import make_bot, make_client
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rate', type=float, default=2000, help="pushes per second sent by the broker")
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--drop-every', type=float, default=10, help="seconds between connection drops, 0 to never drop")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    broker = await FBNSTestBroker(rate=args.rate).start()
+
+    with tempfile.TemporaryDirectory() as sessions_dir:
+        bot = make_bot(sessions_dir)
+        bot.fbns_auth = None
+
+        supervisor = ConnectionSupervisor(
+            lambda: make_client(bot), broker.host, broker.port, ssl=False,
+            min_delay=0.05, max_delay=2.0
+        )
+
+        stop = asyncio.Event()
+        task = asyncio.ensure_future(supervisor.run(stop))
+
+        started = time.monotonic()
+        next_drop = started + args.drop_every if args.drop_every else float('inf')
+        last_pushes, last_at = 0, started
+        while time.monotonic() - started < args.duration:
+            await asyncio.sleep(1)
+
+            now = time.monotonic()
+            if now >= next_drop:
+                next_drop += args.drop_every
+                broker.drop_connections()
+
+            print(f"{now - started:5.0f}s  {(bot.pushes - last_pushes) / (now - last_at):8,.0f} pushes/sec  "
+                  f"reconnects {supervisor.reconnects}")
+            last_pushes, last_at = bot.pushes, now
+
+        stop.set()
+        await task
+        await broker.stop()
+
+        elapsed = time.monotonic() - started
+        print(f"\nreceived {bot.pushes:,} of {broker.pushes_sent:,} pushes sent, {bot.pushes / elapsed:,.0f} pushes/sec")
+        print(f"replies queued {bot.sender.replies:,}, duplicates suppressed {bot.dedup.suppressed}")
+        print(f"connects {broker.connects}, push token registrations {broker.registrations}")
+        print(f"drops {broker.drops}, reconnects {supervisor.reconnects}, last time to reconnect "
+              f"{(supervisor.last_time_to_reconnect or 0) * 1000:.0f}ms, connect failures {supervisor.connect_failures}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,209 @@
+"""Throughput of the push -> reply pipeline, replies are counted instead of sent
+
+Replays synthetic FBNS pushes (or recorded ones, one decoded push JSON per line)
+through FBNSMQTTClient.on_message -> InstagramNotification -> InstagramMQTT.on_fbns_message
+and reports pushes/sec, per stage latencies and allocations.
+
+    python benchmarks/pipeline.py [--pushes 20000] [--replay pushes.jsonl]
+"""
+import os
+import sys
+import json
+import zlib
+import random
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+
+from time import perf_counter_ns
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import InstagramMQTT, HANDLED_COLLAPSE_KEYS, PUNS
+from fbns_mqtt import codec
+from fbns_mqtt.fbns_mqtt import FBNSMQTTClient, FBNSPush
+from notifications import InstagramNotification
+
+
+TEXTS = ["mdr mais pourquoi", "quoi", "Quoiiii ?!", "on mange quoi ce soir", "ok", "trop bien", "c'est vraiment nul", "allo ?", "hein", "non"]
+
+
+def _push(nid, collapse_key, notification):
+    return {
+        "token": "", "ck": 123456789012345, "pn": "com.instagram.android", "cp": collapse_key,
+        "fbpushnotif": json.dumps(notification), "nid": nid, "bu": "0",
+    }
+
+
+def synthetic_push(i):
+    kind = random.choices(("text", "pending", "like", "comment"), weights=(80, 5, 10, 5))[0]
+    thread_id = f"34028236684171030094912817{random.randrange(1000):04d}"
+
+    if kind == "text":
+        return _push(f"nid-{i}", "direct_v2_message", {
+            "m": f"bob: {random.choice(TEXTS)}", "ig": f"direct_v2?id={thread_id}&x=2987342987234",
+            "collapse_key": "direct_v2_message", "c": "direct_v2_text", "s": str(random.randrange(10**9)),
+            "pi": f"pi-{i}", "network_classification": "in_network_group_thread", "badge": 2,
+        })
+    if kind == "pending":
+        return _push(f"nid-{i}", "direct_v2_message", {
+            "m": "bob wants to send you a message.", "ig": f"direct_v2?id={thread_id}&t=p",
+            "collapse_key": "direct_v2_message", "c": "direct_v2_pending", "s": "123", "pi": f"pi-{i}",
+        })
+    if kind == "like":
+        return _push(f"nid-{i}", "like", {
+            "m": "bob liked your post.", "ig": "media?id=1111111111111111111_1111111111",
+            "collapse_key": "like", "s": "123", "pi": f"pi-{i}",
+        })
+    return _push(f"nid-{i}", "comment", {
+        "m": 'bob commented: "mais pourquoi"',
+        "ig": "comments_v2?media_id=1111111111111111111_1111111111&target_comment_id=11111111111111111",
+        "collapse_key": "comment", "s": "123", "pi": f"pi-{i}",
+    })
+
+
+def load_corpus(args):
+    if args.replay:
+        with open(args.replay) as f:
+            pushes = [json.loads(line) for line in f if line.strip()]
+    else:
+        random.seed(args.seed)
+        pushes = [synthetic_push(i) for i in range(args.pushes)]
+
+    return [zlib.compress(json.dumps(push).encode('utf8'), level=9) for push in pushes]
+
+
+class CountingSender(object):
+    executor = None
+
+    def __init__(self):
+        self.replies = 0
+
+    def submit(self, text, thread_id, priority=0):
+        self.replies += 1
+        return True
+
+
+def make_bot(sessions_dir):
+    bot = InstagramMQTT.__new__(InstagramMQTT)
+    bot.init_pipeline("benchmark", sessions_dir=sessions_dir)
+    bot.sender = CountingSender()
+    bot.api = None
+    bot.register_push = lambda token: None
+    return bot
+
+
+def make_client(bot):
+    client = FBNSMQTTClient()
+    client.collapse_keys = HANDLED_COLLAPSE_KEYS
+    client.on_fbns_message = bot.on_fbns_message
+    bot.client = client
+    return client
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda p: samples[min(len(samples) - 1, int(len(samples) * p))] / 1000
+    return pick(0.5), pick(0.99)
+
+
+def run_stages(corpus, sessions_dir):
+    """Every stage timed on its own, push by push"""
+    bot = make_bot(sessions_dir)
+    stages = {name: [] for name in ("decompress+decode", "filter+push", "notification", "match", "on_fbns_message")}
+
+    for raw in corpus:
+        t0 = perf_counter_ns()
+        data = codec.decode_payload(raw)
+        t1 = perf_counter_ns()
+        stages["decompress+decode"].append(t1 - t0)
+
+        if data.get('cp') not in HANDLED_COLLAPSE_KEYS:
+            continue
+
+        codec.decode_nested(data, 'fbpushnotif')
+        push = FBNSPush(data)
+        t2 = perf_counter_ns()
+        stages["filter+push"].append(t2 - t1)
+
+        notification = InstagramNotification(dict(push.payload))
+        t3 = perf_counter_ns()
+        stages["notification"].append(t3 - t2)
+
+        if notification.pushCategory == "direct_v2_text":
+            PUNS.match("fr", notification.message.split(': ', 1)[-1])
+            stages["match"].append(perf_counter_ns() - t3)
+
+        t4 = perf_counter_ns()
+        bot.on_fbns_message(push)
+        stages["on_fbns_message"].append(perf_counter_ns() - t4)
+
+    return stages
+
+
+def run_end_to_end(corpus, sessions_dir):
+    bot = make_bot(sessions_dir)
+    client = make_client(bot)
+    topic = FBNSMQTTClient.MESSAGE_TOPIC_ID
+
+    latencies = []
+    start = perf_counter_ns()
+    for raw in corpus:
+        t0 = perf_counter_ns()
+        client.on_message(client, topic, raw, 0, {})
+        latencies.append(perf_counter_ns() - t0)
+    elapsed = (perf_counter_ns() - start) / 1e9
+
+    return elapsed, latencies, bot
+
+
+def run_allocations(corpus, sessions_dir):
+    bot = make_bot(sessions_dir)
+    client = make_client(bot)
+    topic = FBNSMQTTClient.MESSAGE_TOPIC_ID
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for raw in corpus:
+        client.on_message(client, topic, raw, 0, {})
+    after = tracemalloc.take_snapshot()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    stats = after.compare_to(before, 'filename')
+    blocks = sum(max(0, stat.count_diff) for stat in stats)
+    return peak, blocks
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pushes', type=int, default=20000, help="synthetic pushes to generate")
+    parser.add_argument('--replay', help="JSON lines file of recorded (decompressed) FBNS pushes")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args)
+    print(f"{len(corpus)} pushes, JSON backend: {codec.BACKEND}")
+
+    with tempfile.TemporaryDirectory() as sessions_dir:
+        run_end_to_end(corpus[:1000], sessions_dir) # warm up
+
+        elapsed, latencies, bot = run_end_to_end(corpus, sessions_dir)
+        p50, p99 = percentiles(latencies)
+        print(f"\nend to end: {len(corpus) / elapsed:,.0f} pushes/sec, p50 {p50:.1f}us, p99 {p99:.1f}us")
+        print(f"  replies queued: {bot.sender.replies}, rejected early: {bot.client.rejected_pushes}, "
+              f"duplicates: {bot.dedup.suppressed}")
+
+        print("\nper stage (us)         p50      p99")
+        for name, samples in run_stages(corpus, sessions_dir).items():
+            if samples:
+                p50, p99 = percentiles(samples)
+                print(f"  {name:<18} {p50:7.1f}  {p99:7.1f}")
+
+        peak, blocks = run_allocations(corpus, sessions_dir)
+        print(f"\nallocations: {blocks / len(corpus):.1f} blocks retained per push, peak traced {peak / 1024:.0f} KiB")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
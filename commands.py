@@ -0,0 +1,134 @@
+import asyncio
+import logging
+
+from dedup import DedupWindow
+from sender import COMMAND
+from fbns_mqtt.metrics import REGISTRY
+
+COMMANDS = REGISTRY.counter('qfbot_commands_total', 'Commands by outcome: ok, usage (missing arguments), limited or failed', ('command', 'result'))
+
+
+def parse(text):
+	"""(name, args) of a `/name arg ..` message, None when it is not a command"""
+	if not text or text[0] != '/':
+		return None
+
+	name, _, rest = text[1:].partition(' ')
+	if not name:
+		return None
+	return name.lower(), rest.split()
+
+
+class CommandContext(object):
+	__slots__ = ('name', 'args', 'thread_id', 'user_id', 'username', 'network_classification')
+
+	def __init__(self, name, args, thread_id, user_id, username, network_classification):
+		self.name = name
+		self.args = args
+		self.thread_id = thread_id
+		self.user_id = user_id
+		self.username = username
+		self.network_classification = network_classification
+
+	@property
+	def is_group(self):
+		return self.network_classification == "in_network_group_thread"
+
+
+class Command(object):
+	__slots__ = ('name', 'handler', 'min_args', 'usage', 'recent', 'is_async')
+
+	def __init__(self, name, handler, min_args=0, usage=None, cooldown=0):
+		self.name = name
+		self.handler = handler
+		self.min_args = min_args
+		self.usage = usage or f"/{name}"
+		# Users who ran it during the last `cooldown` seconds
+		self.recent = DedupWindow(capacity=4096, ttl=cooldown) if cooldown else None
+		self.is_async = asyncio.iscoroutinefunction(handler)
+
+
+class CommandRegistry(object):
+	"""Slash commands looked up by name in a dict, whatever their number.
+
+	A handler takes a CommandContext and returns the reply text, or None to
+	stay quiet. Plain handlers run inline and must stay cheap, coroutine
+	handlers (anything doing I/O) run as their own task so the push that
+	triggered them is not held up. Each command can be limited to one run
+	per user every `cooldown` seconds, runs over the limit are ignored.
+	"""
+
+	def __init__(self, reply):
+		self.reply = reply
+
+		self.commands = {}
+		self.handled = 0
+		self.limited = 0
+		self.failed = 0
+
+	def register(self, name, handler, min_args=0, usage=None, cooldown=0):
+		self.commands[name.lower()] = Command(name.lower(), handler, min_args, usage, cooldown)
+
+	def command(self, name, **kwargs):
+		"""Decorator version of register()"""
+		def decorator(handler):
+			self.register(name, handler, **kwargs)
+			return handler
+		return decorator
+
+	def dispatch(self, text, thread_id, user_id, username=None, network_classification=None):
+		"""Run the command `text` holds, False when it is no registered command"""
+		parsed = parse(text)
+		if parsed is None:
+			return False
+
+		command = self.commands.get(parsed[0])
+		if command is None:
+			return False
+
+		self.handled += 1
+		if len(parsed[1]) < command.min_args:
+			# Checked first, a malformed command does not count towards the cooldown
+			COMMANDS.inc(command.name, 'usage')
+			self.reply(f"Usage: {command.usage}", thread_id, COMMAND)
+			return True
+
+		if command.recent is not None and command.recent.seen(str(user_id)):
+			self.limited += 1
+			COMMANDS.inc(command.name, 'limited')
+			return True
+
+		context = CommandContext(parsed[0], parsed[1], thread_id, user_id, username, network_classification)
+		if command.is_async:
+			asyncio.ensure_future(self._run(command, context))
+		else:
+			try:
+				self._done(command, context, command.handler(context))
+			except Exception as e:
+				self._failed(command, e)
+
+		return True
+
+	async def _run(self, command, context):
+		try:
+			self._done(command, context, await command.handler(context))
+		except Exception as e:
+			self._failed(command, e)
+
+	def _done(self, command, context, text):
+		COMMANDS.inc(command.name, 'ok')
+		if text:
+			self.reply(text, context.thread_id, COMMAND)
+
+	def _failed(self, command, e):
+		self.failed += 1
+		COMMANDS.inc(command.name, 'failed')
+		logging.error(f"Command /{command.name} failed: {e!r}")
+
+	@property
+	def metrics(self):
+		return {
+			"commands": self.handled,
+			"commands_limited": self.limited,
+			"commands_failed": self.failed
+		}
@@ -0,0 +1,208 @@
+import time
+import asyncio
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+from sender import TokenBucket, call
+from fbns_mqtt.metrics import REGISTRY
+
+COMMENT_REPLIES = REGISTRY.counter('qfbot_comment_replies_total', 'Comment replies by outcome: sent, failed, dropped (queue full) or unresolved', ('result',))
+COMMENT_FETCHES = REGISTRY.counter('qfbot_comment_fetches_total', 'Comment pages fetched, one per media batch at most')
+
+
+def preview_text(message):
+	"""Comment text of a `USERNAME commented: "TEXT"` push, None when Instagram cut it short"""
+	_, sep, text = (message or '').partition(': ')
+	if not sep:
+		return None
+
+	text = text.strip()
+	if len(text) >= 2 and text[0] == text[-1] == '"':
+		text = text[1:-1]
+
+	if not text or text.endswith(('...', '…')):
+		return None
+	return text
+
+
+class CommentRequest(object):
+	__slots__ = ('media_id', 'comment_id', 'user_id', 'username', 'text')
+
+	def __init__(self, media_id, comment_id, user_id, username, text):
+		self.media_id = media_id
+		self.comment_id = comment_id
+		self.user_id = user_id
+		self.username = username
+		self.text = text
+
+
+class CommentReplier(object):
+	"""Answers comments from its own worker, away from the DM reply path.
+
+	Comments on the same media are batched for `batch_window` seconds. The
+	push usually holds the whole comment text, the comments of the media are
+	only fetched (once per batch, then cached for `cache_ttl` seconds) when
+	it was cut short or the comment id is missing.
+
+	`fetch(media_id)` returns the recent comments as [{"pk", "text",
+	"user_id"}, ..] and `send(media_id, text, replied_to_comment_id)` posts
+	the reply, either can be a coroutine function or a blocking call run in
+	the replier's own thread. `respond(request)` returns the reply text, or
+	None to stay quiet. Replies share a token bucket of their own.
+	"""
+
+	def __init__(self, fetch, send, respond, rate=0.1, burst=2, batch_window=2.0,
+			cache_ttl=30.0, cache_size=256, max_queue=256, executor=None):
+		self.fetch = fetch
+		self.send = send
+		self.respond = respond
+
+		self.bucket = TokenBucket(rate, burst)
+		self.batch_window = batch_window
+		self.cache_ttl = cache_ttl
+		self.cache_size = cache_size
+		self.max_queue = max_queue
+		self.executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix="comments")
+
+		self.queued = 0
+		self.sent = 0
+		self.failed = 0
+		self.dropped = 0
+		self.fetches = 0
+		self.cache_hits = 0
+
+		self._pending = 0
+		self._batches = {} # media_id -> [CommentRequest, ..]
+		self._cache = {} # media_id -> (expires, {comment_id: comment})
+		self._ready = None
+		self._task = None
+
+	@property
+	def running(self):
+		return self._task is not None
+
+	def start(self):
+		if self.running:
+			return
+
+		self._ready = asyncio.Queue()
+		self._task = asyncio.ensure_future(self._worker())
+
+	async def stop(self, drain=True, timeout=10.0):
+		"""Wait up to `timeout` seconds for the queued comments to be answered, then drop the rest"""
+		if not self.running:
+			return
+
+		deadline = time.monotonic() + timeout
+		while drain and self._pending and time.monotonic() < deadline:
+			await asyncio.sleep(0.05)
+
+		if self._pending:
+			logging.warning(f"Stopping with {self._pending} comments still queued, dropped")
+
+		self._task.cancel()
+		await asyncio.gather(self._task, return_exceptions=True)
+		self._task = None
+		self._batches.clear()
+		self._pending = 0
+
+	def submit(self, media_id, comment_id, user_id, username, text):
+		"""Queue a comment to answer, `text` is None when unknown, returns False when dropped"""
+		if not self.running or self._pending >= self.max_queue:
+			self.dropped += 1
+			COMMENT_REPLIES.inc('dropped')
+			return False
+
+		self._pending += 1
+		self.queued += 1
+
+		batch = self._batches.get(media_id)
+		if batch is None:
+			batch = self._batches[media_id] = []
+			asyncio.get_event_loop().call_later(self.batch_window, self._ready.put_nowait, media_id)
+		batch.append(CommentRequest(media_id, comment_id, user_id, username, text))
+
+		return True
+
+	async def _comments(self, media_id, wanted):
+		now = time.monotonic()
+		cached = self._cache.get(media_id)
+		if cached is not None and cached[0] > now and wanted <= cached[1].keys():
+			self.cache_hits += 1
+			return cached[1]
+
+		self.fetches += 1
+		COMMENT_FETCHES.inc()
+		comments = {str(comment['pk']): comment for comment in await call(self.executor, self.fetch, media_id)}
+
+		self._cache[media_id] = (now + self.cache_ttl, comments)
+		if len(self._cache) > self.cache_size:
+			for key, (expires, _) in list(self._cache.items()):
+				if expires <= now:
+					del self._cache[key]
+
+		return comments
+
+	def _resolve(self, request, comments):
+		if request.comment_id is not None:
+			comment = comments.get(str(request.comment_id))
+		else:
+			# No comment id in the push (mentions), latest comment of its author
+			comment = next((c for c in comments.values() if str(c['user_id']) == str(request.user_id)), None)
+
+		if comment is not None:
+			request.comment_id = comment['pk']
+			request.text = comment['text']
+
+	async def _answer(self, media_id, batch):
+		unresolved = [request for request in batch if request.text is None or request.comment_id is None]
+		if unresolved:
+			# A comment newer than the cached page means fetching it again, still once for the whole batch
+			wanted = {str(request.comment_id) for request in unresolved if request.comment_id is not None}
+			comments = await self._comments(media_id, wanted)
+			for request in unresolved:
+				self._resolve(request, comments)
+
+		for request in batch:
+			if request.text is None or request.comment_id is None:
+				COMMENT_REPLIES.inc('unresolved')
+				continue
+
+			text = self.respond(request)
+			if not text:
+				continue
+
+			await self.bucket.acquire()
+			try:
+				await call(self.executor, self.send, media_id, text, request.comment_id)
+				self.sent += 1
+				COMMENT_REPLIES.inc('sent')
+			except Exception as e:
+				self.failed += 1
+				COMMENT_REPLIES.inc('failed')
+				logging.error(f"Could not reply to comment {request.comment_id} on {media_id}: {e!r}")
+
+	async def _worker(self):
+		while True:
+			media_id = await self._ready.get()
+			batch = self._batches.pop(media_id, [])
+			try:
+				await self._answer(media_id, batch)
+			except Exception as e:
+				self.failed += len(batch)
+				COMMENT_REPLIES.inc('failed', amount=len(batch))
+				logging.error(f"Could not answer comments on {media_id}: {e!r}")
+			finally:
+				self._pending -= len(batch)
+
+	@property
+	def metrics(self):
+		return {
+			"comments_queued": self.queued,
+			"comments_sent": self.sent,
+			"comments_failed": self.failed,
+			"comments_dropped": self.dropped,
+			"comment_fetches": self.fetches,
+			"comment_cache_hits": self.cache_hits
+		}
@@ -0,0 +1,83 @@
+import json
+import time
+import logging
+
+from collections import deque
+
+from fbns_mqtt.state import atomic_write
+
+
+class DedupWindow(object):
+	"""Ids seen during the last `ttl` seconds, at most `capacity` of them.
+
+	A ring buffer keeps the arrival order for expiry and eviction while a set
+	answers membership, both in O(1) and in a fixed amount of memory.
+	"""
+
+	def __init__(self, capacity=4096, ttl=3600.0):
+		self.capacity = capacity
+		self.ttl = ttl
+
+		self.suppressed = 0
+
+		self._ring = deque() # (expires_at, key), oldest first
+		self._seen = set()
+
+	def __len__(self):
+		return len(self._seen)
+
+	def __contains__(self, key):
+		"""Like seen() without remembering `key`"""
+		self._expire(time.time())
+		return key in self._seen
+
+	def _expire(self, now):
+		while self._ring and (self._ring[0][0] <= now or len(self._ring) > self.capacity):
+			_, key = self._ring.popleft()
+			self._seen.discard(key)
+
+	def _add(self, key, expires_at):
+		self._ring.append((expires_at, key))
+		self._seen.add(key)
+
+	def seen(self, key):
+		"""True if `key` already went through the window, else remember it and return False"""
+		if key is None:
+			return False
+
+		now = time.time()
+		self._expire(now)
+
+		if key in self._seen:
+			self.suppressed += 1
+			return True
+
+		self._add(key, now + self.ttl)
+		self._expire(now)
+		return False
+
+	def load(self, path):
+		try:
+			with open(path, 'r') as f:
+				entries = json.load(f)
+		except FileNotFoundError:
+			return
+		except (OSError, ValueError) as e:
+			logging.warning(f"Ignoring unreadable dedup window {path}: {e!r}")
+			return
+
+		now = time.time()
+		for expires_at, key in entries:
+			if expires_at > now and key not in self._seen:
+				self._add(key, expires_at)
+		self._expire(now)
+
+	def save(self, path):
+		atomic_write(path, json.dumps(list(self._ring), separators=(',', ':')).encode('utf8'))
+
+	@property
+	def metrics(self):
+		return {
+			"dedup_size": len(self._seen),
+			"duplicates_suppressed": self.suppressed
+		}
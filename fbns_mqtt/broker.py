@@ -0,0 +1,260 @@
+"""Local stand-in for mqtt-mini.facebook.com, to load test FBNSMQTTClient offline.
+
+Speaks just enough MQTToT: accepts the thrift/zlib CONNECT built by
+FBNSConnectPackageFactor, answers with a CONNACK carrying an FBNS auth blob,
+answers /fbns_reg_req with a push token, then publishes compressed pushes on
+topic 76 at a configurable rate. Connections can be dropped on demand.
+
+    python -m fbns_mqtt.broker --port 8883 --rate 200 --drop-every 30
+"""
+import time
+import uuid
+import zlib
+import struct
+import signal
+import asyncio
+import logging
+import argparse
+
+from thriftpy2.protocol import TCompactProtocol
+from thriftpy2.transport import TMemoryBuffer
+
+from . import codec
+from .fbns_mqtt import thrift, FBNSMQTTClient
+
+logger = logging.getLogger(__name__)
+
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PUBACK = 0x40
+PINGREQ = 0xC0
+PINGRESP = 0xD0
+DISCONNECT = 0xE0
+
+
+def _pack_remaining_length(n):
+    out = bytearray()
+    while True:
+        n, digit = divmod(n, 128)
+        out.append(digit | (0x80 if n else 0))
+        if not n:
+            return bytes(out)
+
+
+def _packet(command, body):
+    return bytes([command]) + _pack_remaining_length(len(body)) + body
+
+
+def _string(s):
+    s = s.encode('utf8') if isinstance(s, str) else s
+    return struct.pack('!H', len(s)) + s
+
+
+def publish_packet(topic, payload):
+    return _packet(PUBLISH, _string(topic) + payload)
+
+
+def decode_connect(body):
+    """Variable header and thrift Connect struct of a CONNECT packet body"""
+    name_len, = struct.unpack('!H', body[:2])
+    proto_name = body[2:2 + name_len]
+    proto_ver, flags, keepalive = struct.unpack('!BBH', body[2 + name_len:6 + name_len])
+
+    connect = thrift.Connect()
+    TCompactProtocol(TMemoryBuffer(zlib.decompress(body[6 + name_len:]))).read_struct(connect)
+    return proto_name, proto_ver, keepalive, connect
+
+
+def sample_push(i):
+    notification = {
+        "m": "bob: mais pourquoi", "ig": f"direct_v2?id=3402823668417103009491281{i % 1000:04d}&x=2987342987234",
+        "collapse_key": "direct_v2_message", "c": "direct_v2_text", "s": str(1000 + i % 50),
+        "pi": uuid.uuid4().hex, "network_classification": "in_network_group_thread",
+    }
+    return {
+        "token": "", "ck": 123456789012345, "pn": "com.instagram.android", "cp": "direct_v2_message",
+        "fbpushnotif": codec.dumps(notification), "nid": uuid.uuid4().hex, "bu": "0",
+    }
+
+
+class _Session(object):
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.connect = None
+        self.blaster = None
+
+
+class FBNSTestBroker(object):
+    def __init__(self, host='127.0.0.1', port=0, rate=0.0, push_factory=sample_push, tick=0.01):
+        self.host = host
+        self.port = port
+        self.rate = rate
+        self.push_factory = push_factory
+        self.tick = tick
+
+        self.connects = 0
+        self.registrations = 0
+        self.pushes_sent = 0
+        self.drops = 0
+
+        self._server = None
+        self._sessions = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f'[BROKER] Listening on {self.host}:{self.port}')
+        return self
+
+    async def stop(self):
+        self.drop_connections(count=False)
+        self._server.close()
+        await self._server.wait_closed()
+
+    def drop_connections(self, count=True):
+        """Cut every client connection without a DISCONNECT, like a network blip would"""
+        for session in list(self._sessions):
+            if count:
+                self.drops += 1
+            session.writer.transport.abort()
+
+    async def _read_packet(self, reader):
+        header = await reader.readexactly(1)
+        length, multiplier = 0, 1
+        while True:
+            digit = (await reader.readexactly(1))[0]
+            length += (digit & 0x7F) * multiplier
+            multiplier *= 128
+            if not digit & 0x80:
+                break
+        return header[0], await reader.readexactly(length)
+
+    async def _handle(self, reader, writer):
+        session = _Session(reader, writer)
+        self._sessions.add(session)
+        try:
+            while True:
+                header, body = await self._read_packet(reader)
+                command = header & 0xF0
+
+                if command == CONNECT:
+                    self._on_connect(session, body)
+                elif command == PUBLISH:
+                    self._on_publish(session, header, body)
+                elif command == PINGREQ:
+                    writer.write(_packet(PINGRESP, b''))
+                elif command == DISCONNECT:
+                    break
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+        finally:
+            self._sessions.discard(session)
+            if session.blaster:
+                session.blaster.cancel()
+            writer.close()
+
+    def _on_connect(self, session, body):
+        proto_name, proto_ver, keepalive, connect = decode_connect(body)
+        session.connect = connect
+        self.connects += 1
+
+        client_info = connect.clientInfo
+        auth = {
+            "ck": client_info.userId or 123456789012345,
+            "cs": connect.password or uuid.uuid4().hex,
+            "di": client_info.deviceId or str(uuid.uuid4()),
+            "ds": client_info.deviceSecret or uuid.uuid4().hex,
+            "sr": "", "rc": "",
+        }
+        logger.debug(f'[BROKER] CONNECT {proto_name} v{proto_ver} session {client_info.clientMqttSessionId}')
+
+        session.writer.write(_packet(CONNACK, b'\x00\x00' + _string(codec.dumps(auth))))
+
+        if self.rate > 0:
+            session.blaster = asyncio.ensure_future(self._blast(session))
+
+    def _on_publish(self, session, header, body):
+        qos = (header & 0x06) >> 1
+        topic_len, = struct.unpack('!H', body[:2])
+        topic = body[2:2 + topic_len].decode('utf8')
+        rest = body[2 + topic_len:]
+
+        if qos:
+            session.writer.write(_packet(PUBACK, rest[:2]))
+
+        if topic in (FBNSMQTTClient.REG_REQ_TOPIC, FBNSMQTTClient.REG_REQ_TOPIC_ID):
+            self.registrations += 1
+            token = codec.dumps({"token": uuid.uuid4().hex, "error": ""}).encode('utf8')
+            session.writer.write(publish_packet(FBNSMQTTClient.REG_RESP_TOPIC_ID, zlib.compress(token)))
+
+    async def _blast(self, session):
+        sent = 0
+        started = time.monotonic()
+        while True:
+            await asyncio.sleep(self.tick)
+
+            due = int((time.monotonic() - started) * self.rate) - sent
+            if due <= 0:
+                continue
+
+            data = b''.join(
+                publish_packet(FBNSMQTTClient.MESSAGE_TOPIC_ID, zlib.compress(codec.dumps(self.push_factory(self.pushes_sent + i)).encode('utf8')))
+                for i in range(due)
+            )
+            session.writer.write(data)
+            sent += due
+            self.pushes_sent += due
+            await session.writer.drain()
+
+    @property
+    def metrics(self):
+        return {
+            "connections": len(self._sessions),
+            "connects": self.connects,
+            "registrations": self.registrations,
+            "pushes_sent": self.pushes_sent,
+            "drops": self.drops
+        }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8883)
+    parser.add_argument('--rate', type=float, default=100.0, help="pushes per second and per connection")
+    parser.add_argument('--drop-every', type=float, default=0, help="drop all connections every N seconds")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s')
+
+    broker = await FBNSTestBroker(args.host, args.port, rate=args.rate).start()
+
+    loop = asyncio.get_event_loop()
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGINT, stop.set)
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    # kill -USR1 <pid> drops connections on demand
+    loop.add_signal_handler(signal.SIGUSR1, broker.drop_connections)
+
+    next_drop = time.monotonic() + args.drop_every
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=min(5, args.drop_every or 5))
+        except asyncio.TimeoutError:
+            pass
+
+        if args.drop_every and time.monotonic() >= next_drop:
+            next_drop += args.drop_every
+            broker.drop_connections()
+
+        logger.info(f'[BROKER] {broker.metrics}')
+
+    await broker.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
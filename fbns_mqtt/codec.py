@@ -0,0 +1,52 @@
+"""JSON/zlib decoding used on every push, orjson or ujson are used when installed"""
+import zlib
+
+try:
+    import orjson
+
+    BACKEND = 'orjson'
+
+    loads = orjson.loads
+
+    def dumps(obj):
+        return orjson.dumps(obj).decode('utf8')
+
+except ImportError:
+    try:
+        import ujson
+
+        BACKEND = 'ujson'
+
+        loads = ujson.loads
+        dumps = ujson.dumps
+
+    except ImportError:
+        import json
+
+        BACKEND = 'json'
+
+        loads = json.loads
+        dumps = json.dumps
+
+
+def decompress(data):
+    # A zlib.decompressobj cannot be reused once a stream ended and every push is a full stream,
+    # the one-shot call is the cheapest way through
+    return zlib.decompress(data)
+
+
+def compress(data, level=9):
+    return zlib.compress(data, level=level)
+
+
+def decode_payload(data):
+    """Inflate and decode an MQTT payload, bytes in, object out"""
+    return loads(decompress(data))
+
+
+def decode_nested(data, key):
+    """Decode in place a JSON document embedded as a string under `key`"""
+    value = data.get(key)
+    if isinstance(value, (str, bytes)):
+        data[key] = loads(value)
+    return data
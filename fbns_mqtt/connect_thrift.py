@@ -0,0 +1,104 @@
+"""Structs of connect.thrift declared directly, importing them does not run the thrift parser.
+
+Keep in sync with connect.thrift, `python -m fbns_mqtt.connect_thrift` checks both match.
+"""
+from thriftpy2.thrift import TPayload, TType, gen_init
+
+
+def _struct(name, fields):
+    """`fields` as (id, name, ttype spec..), like thriftpy2.load would build it"""
+    cls = type(name, (TPayload,), {'__module__': __name__, '_ttype': TType.STRUCT})
+    cls.thrift_spec = {field[0]: field[1:] for field in fields}
+    cls.default_spec = [(field[2], None) for field in fields]
+    gen_init(cls, cls.thrift_spec, cls.default_spec)
+    return cls
+
+
+ClientInfo = _struct('ClientInfo', [
+    (1, TType.I64, 'userId', False),
+    (2, TType.STRING, 'userAgent', False),
+    (3, TType.I64, 'clientCapabilities', False),
+    (4, TType.I64, 'endpointCapabilities', False),
+    (5, TType.I32, 'publishFormat', False),
+    (6, TType.BOOL, 'noAutomaticForeground', False),
+    (7, TType.BOOL, 'makeUserAvailableInForeground', False),
+    (8, TType.STRING, 'deviceId', False),
+    (9, TType.BOOL, 'isInitiallyForeground', False),
+    (10, TType.I32, 'networkType', False),
+    (11, TType.I32, 'networkSubtype', False),
+    (12, TType.I64, 'clientMqttSessionId', False),
+    (13, TType.STRING, 'clientIpAddress', False),
+    (14, TType.LIST, 'subscribeTopics', TType.I32, False),
+    (15, TType.STRING, 'clientType', False),
+    (16, TType.I64, 'appId', False),
+    (17, TType.BOOL, 'overrideNectarLogging', False),
+    (18, TType.STRING, 'connectTokenHash', False),
+    (19, TType.STRING, 'regionPreference', False),
+    (20, TType.STRING, 'deviceSecret', False),
+    (21, TType.BYTE, 'clientStack', False),
+    (22, TType.I64, 'fbnsConnectionKey', False),
+    (23, TType.STRING, 'fbnsConnectionSecret', False),
+    (24, TType.STRING, 'fbnsDeviceId', False),
+    (25, TType.STRING, 'fbnsDeviceSecret', False),
+])
+
+GetIrisDiffs = _struct('GetIrisDiffs', [
+    (1, TType.STRING, 'syncToken', False),
+    (2, TType.I64, 'lastSeqId', False),
+    (3, TType.I32, 'maxDeltasAbleToProcess', False),
+    (4, TType.I32, 'deltaBatchSize', False),
+    (5, TType.STRING, 'encoding', False),
+    (6, TType.STRING, 'queueType', False),
+    (7, TType.I32, 'syncApiVersion', False),
+    (8, TType.STRING, 'deviceId', False),
+    (9, TType.STRING, 'deviceParams', False),
+    (10, TType.STRING, 'queueParams', False),
+    (11, TType.I64, 'entityFbid', False),
+    (12, TType.I64, 'syncTokenLong', False),
+])
+
+ProxygenInfo = _struct('ProxygenInfo', [
+    (1, TType.STRING, 'ipAddr', False),
+    (2, TType.STRING, 'hostName', False),
+    (3, TType.STRING, 'vipAddr', False),
+])
+
+CombinedPublish = _struct('CombinedPublish', [
+    (1, TType.STRING, 'topic', False),
+    (2, TType.I32, 'messageId', False),
+    (3, TType.STRING, 'payload', False),
+])
+
+Connect = _struct('Connect', [
+    (1, TType.STRING, 'clientIdentifier', False),
+    (2, TType.STRING, 'willTopic', False),
+    (3, TType.STRING, 'willMessage', False),
+    (4, TType.STRUCT, 'clientInfo', ClientInfo, False),
+    (5, TType.STRING, 'password', False),
+    (6, TType.LIST, 'getDiffsRequests', TType.STRING, False),
+    (7, TType.LIST, 'proxygenInfo', (TType.STRUCT, ProxygenInfo), False),
+    (8, TType.LIST, 'combinedPublishes', (TType.STRUCT, CombinedPublish), False),
+    (9, TType.STRING, 'zeroRatingTokenHash', False),
+    (10, TType.MAP, 'appSpecificInfo', (TType.STRING, TType.STRING), False),
+])
+
+
+def _spec(value):
+    # Struct classes compared by name, the parsed ones live in another module
+    if isinstance(value, type):
+        return value.__name__
+    if isinstance(value, tuple):
+        return tuple(_spec(v) for v in value)
+    return value
+
+
+if __name__ == "__main__":
+    import os
+    import thriftpy2
+
+    parsed = thriftpy2.load(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'connect.thrift'), module_name='parsed_thrift')
+    for name in ('ClientInfo', 'GetIrisDiffs', 'ProxygenInfo', 'CombinedPublish', 'Connect'):
+        expected = {fid: _spec(spec) for fid, spec in getattr(parsed, name).thrift_spec.items()}
+        declared = {fid: _spec(spec) for fid, spec in globals()[name].thrift_spec.items()}
+        assert expected == declared, f"{name} differs from connect.thrift"
+    print("connect_thrift matches connect.thrift")
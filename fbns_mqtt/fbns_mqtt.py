@@ -1,16 +1,14 @@
-import os
 import json
 import time
 import uuid
 import zlib
 import struct
 import asyncio
-import calendar
-from os import getcwd
-from os.path import relpath
-from datetime import datetime
+from datetime import datetime, timedelta
 from urllib.parse import urlsplit, parse_qs
-from dateutil.relativedelta import relativedelta
+
+from . import codec
+from .metrics import REGISTRY
 
 from gmqtt import Client
 from gmqtt.client import logger
@@ -21,15 +19,17 @@ from gmqtt.mqtt.package import PackageFactory
 from gmqtt.mqtt.protocol import MQTTProtocol
 from gmqtt.mqtt.utils import pack_variable_byte_integer
 
-import thriftpy2 as thriftpy
 from thriftpy2.protocol import TCompactProtocol
 from thriftpy2.transport import TMemoryBuffer
 
-ABSOLUTE_PATH = lambda x: os.path.abspath(os.path.join(os.path.abspath(os.path.dirname(__file__)), x))
+# connect.thrift, declared in Python rather than parsed on every start
+from . import connect_thrift as thrift
 
 
-file_path_rel = relpath(ABSOLUTE_PATH('connect.thrift'), getcwd())
-thrift = thriftpy.load(file_path_rel, module_name="connect_thrift")
+PUSHES = REGISTRY.counter('fbns_pushes_total', 'Pushes received, by collapse key', ('collapse_key',))
+PUSHES_REJECTED = REGISTRY.counter('fbns_pushes_rejected_total', 'Pushes dropped by the collapse key filter', ('collapse_key',))
+DECOMPRESS_SECONDS = REGISTRY.histogram('fbns_decompress_seconds', 'zlib inflate time of a payload')
+DECODE_SECONDS = REGISTRY.histogram('fbns_decode_seconds', 'JSON decode time of a payload')
 
 
 class FBNSAuth(object):
@@ -52,6 +52,9 @@ def _spop(d, k):
 
 
 class FBNSPush(object):
+    __slots__ = ('token', 'connectionKey', 'packageName', 'collapseKey', 'payload', 'notificationId', 'isBuffered',
+                 'viewId', 'numEndpoints', 'ipjid', 'qt', 'mt', 'l', 'j')
+
     def __init__(self, data):
         self.token = _spop(data, 'token')
         self.connectionKey = _spop(data, 'ck')
@@ -73,11 +76,57 @@ class FBNSPush(object):
             raise Exception('FBNSPush unexpected data: {data}'.format(**locals()))
 
 
-class FBNSConnectPackageFactor(PackageFactory):
+def _pack_compact_i64(n):
+    # TCompactProtocol i64: zigzag then varint
+    n = ((n << 1) ^ (n >> 63)) & 0xFFFFFFFFFFFFFFFF
+    out = bytearray()
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+class FBNSConnectTemplate(object):
+    """CONNECT payload of an FBNSAuth, serialized and compressed once.
+
+    Only clientMqttSessionId changes from one connect to the next: the
+    payload is serialized with a placeholder session id and split around it,
+    and the level 9 compressor state after the part before it is kept so a
+    connect only compresses the few bytes from the session id on.
+    """
+
+    # Distinctive enough not to show up anywhere else in the serialized struct
+    SESSION_ID_PLACEHOLDER = 0x5A5A5A5A5A5A5A
+
+    _cache = {}
+    _cache_size = 8
+
     @classmethod
-    def build_package(cls, fbns_auth: FBNSAuth, clean_session, keepalive, protocol, will_message=None, **kwargs):
-        keepalive = 900
+    def for_auth(cls, fbns_auth):
+        key = (fbns_auth.clientId, fbns_auth.userId, fbns_auth.password, fbns_auth.deviceId, fbns_auth.deviceSecret)
+        template = cls._cache.get(key)
+        if template is None:
+            if len(cls._cache) >= cls._cache_size:
+                cls._cache.clear()
+            template = cls._cache[key] = cls(fbns_auth)
+        return template
+
+    def __init__(self, fbns_auth):
+        data = self.serialize(fbns_auth, self.SESSION_ID_PLACEHOLDER)
+
+        marker = _pack_compact_i64(self.SESSION_ID_PLACEHOLDER)
+        if data.count(marker) == 1:
+            prefix, self._suffix = data.split(marker)
+            self._compressor = zlib.compressobj(level=9)
+            self._head = self._compressor.compress(prefix)
+        else:
+            # Can't tell where the session id is, serialize everything on every connect
+            self._compressor = None
+            self._auth = fbns_auth
 
+    @staticmethod
+    def serialize(fbns_auth, session_id):
         connect_payload = thrift.Connect()
         connect_payload.clientIdentifier = fbns_auth.clientId
 
@@ -93,11 +142,6 @@ class FBNSConnectPackageFactor(PackageFactory):
         client_info.isInitiallyForeground = False
         client_info.networkType = 1
         client_info.networkSubtype = 0
-
-        last_monday = datetime.now() - relativedelta(weekday=calendar.MONDAY, hour=0, minute=0, second=0, microsecond=0)
-        last_monday = last_monday.timestamp()
-        session_id = int((time.time() - last_monday) * 1000)
-
         client_info.clientMqttSessionId = session_id
         client_info.subscribeTopics = [int(FBNSMQTTClient.MESSAGE_TOPIC_ID), int(FBNSMQTTClient.REG_RESP_TOPIC_ID)]
         client_info.clientType = 'device_auth'
@@ -112,8 +156,27 @@ class FBNSConnectPackageFactor(PackageFactory):
         p = TCompactProtocol(trans)
         p.write_struct(connect_payload)
 
-        data = trans.getvalue()
-        prop_bytes = zlib.compress(data, level=9)
+        return trans.getvalue()
+
+    def payload(self, session_id):
+        if self._compressor is None:
+            return zlib.compress(self.serialize(self._auth, session_id), level=9)
+
+        compressor = self._compressor.copy()
+        return self._head + compressor.compress(_pack_compact_i64(session_id) + self._suffix) + compressor.flush()
+
+
+class FBNSConnectPackageFactor(PackageFactory):
+    @classmethod
+    def build_package(cls, fbns_auth: FBNSAuth, clean_session, keepalive, protocol, will_message=None, **kwargs):
+        keepalive = 900
+
+        # Milliseconds since the start of the week, Monday 00:00 local time
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        last_monday = (today - timedelta(days=today.weekday())).timestamp()
+        session_id = int((time.time() - last_monday) * 1000)
+
+        prop_bytes = FBNSConnectTemplate.for_auth(fbns_auth).payload(session_id)
 
         remaining_length = 2 + len(protocol.proto_name) + 1 + 1 + 2
 
@@ -221,6 +284,10 @@ class FBNSMQTTClient(Client):
         self._on_fbns_auth_callback = _empty_callback
         self._on_fbns_message_callback = _empty_callback
 
+        # Collapse keys worth decoding, None lets every push through
+        self.collapse_keys = None
+        self.rejected_pushes = 0
+
     @property
     def on_fbns_message(self):
         return self._on_fbns_message_callback
@@ -252,9 +319,23 @@ class FBNSMQTTClient(Client):
         self._on_fbns_token_callback = cb
 
     def on_message(self, _, topic, payload, qos, properties):
-        payload = zlib.decompress(payload)
-        payload = json.loads(payload)
+        start = time.perf_counter()
+        payload = codec.decompress(payload)
+        inflated = time.perf_counter()
+        payload = codec.loads(payload)
+        DECOMPRESS_SECONDS.observe(inflated - start)
+        DECODE_SECONDS.observe(time.perf_counter() - inflated)
+
         if topic == self.MESSAGE_TOPIC_ID:
+            collapse_key = payload.get('cp')
+            PUSHES.inc(collapse_key)
+            if self.collapse_keys is not None and collapse_key not in self.collapse_keys:
+                # Likes, posts, stories.. dropped before building anything out of them
+                self.rejected_pushes += 1
+                PUSHES_REJECTED.inc(collapse_key)
+                return
+            # Instagram notification JSON is decoded here once, InstagramNotification gets a dict
+            codec.decode_nested(payload, 'fbpushnotif')
             push = FBNSPush(payload)
             self._on_fbns_message(push)
         elif topic == self.REG_RESP_TOPIC_ID:
@@ -264,7 +345,7 @@ class FBNSMQTTClient(Client):
 
     def _on_fbns_message(self, payload):
         # It's instagram event
-        logger.debug('[FBNS_MSG] {payload}'.format(**locals()))
+        logger.debug('[FBNS_MSG] %s', payload)
         self.on_fbns_message(payload)
 
     def _on_fbns_register(self, payload):
@@ -277,7 +358,8 @@ class FBNSMQTTClient(Client):
         self.on_fbns_token(token)
 
     async def _create_connection(self, host, port, ssl, clean_session, keepalive) -> FBNSMQTTConnection:
-        self._reconnect = True
+        # gmqtt's own reconnect can't authenticate with FBNS, reconnects are done by ConnectionSupervisor
+        self._reconnect = False
         connection = await FBNSMQTTConnection.create_connection(host, port, ssl, clean_session, keepalive)
         connection.set_handler(self)
         return connection
@@ -323,9 +405,9 @@ class FBNSMQTTClient(Client):
                                     **self._connect_properties)
         await self._connected.wait()
 
-        loop = asyncio.get_event_loop()
-        while not await self._persistent_storage.is_empty:
-            await loop.create_future()
+        # The /fbns_reg_req publish sent on CONNACK is still waiting for its PUBACK here,
+        # waiting on a bare future for it would never return
+        await self._persistent_storage.wait_empty()
 
         if self._error:
             raise self._error
@@ -0,0 +1,176 @@
+"""Counters and histograms for the hot path, exposed in the Prometheus text format.
+
+Everything runs on the event loop thread, recording a value is a dict lookup
+and an addition, cheap enough to stay on in production.
+"""
+import time
+import asyncio
+import logging
+
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+def _escape(value):
+    if value is None:
+        return ''
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield self.name, _labels(self.labelnames, labels), value
+
+
+class Histogram(object):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {} # labels -> [count per bucket.., count above the last one, sum]
+
+    def observe(self, value, *labels):
+        values = self._values.get(labels)
+        if values is None:
+            values = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        values[bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def count(self, *labels):
+        values = self._values.get(labels)
+        return sum(values[:-1]) if values else 0
+
+    def samples(self):
+        for labels, values in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values):
+                cumulative += count
+                yield f'{self.name}_bucket', _labels(self.labelnames, labels, (('le', bound),)), cumulative
+            yield f'{self.name}_sum', _labels(self.labelnames, labels), values[-1]
+            yield f'{self.name}_count', _labels(self.labelnames, labels), cumulative
+
+
+class _Timer(object):
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            return self._metrics[metric.name]
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def add_collector(self, collect):
+        """`collect()` is called on every scrape and returns {name: value} gauges, or ({name: value}, {label: value})"""
+        self._collectors.append(collect)
+        return collect
+
+    def remove_collector(self, collect):
+        if collect in self._collectors:
+            self._collectors.remove(collect)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(f'{name}{labels} {value}' for name, labels, value in metric.samples())
+
+        gauges = {}
+        for collect in list(self._collectors):
+            try:
+                collected = collect()
+            except Exception as e:
+                logger.warning(f'Metrics collector failed: {e!r}')
+                continue
+
+            values, labels = collected if isinstance(collected, tuple) else (collected, {})
+            for name, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    gauges.setdefault(name, []).append((_labels(labels.keys(), labels.values()), value))
+
+        for name, samples in gauges.items():
+            lines.append(f'# TYPE {name} gauge')
+            lines.extend(f'{name}{labels} {value}' for labels, value in samples)
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+async def serve(port, host='127.0.0.1', registry=REGISTRY):
+    """Minimal HTTP endpoint answering every GET with the registry, for Prometheus to scrape"""
+    async def handle(reader, writer):
+        try:
+            request = await reader.readuntil(b'\r\n\r\n')
+            if request.startswith(b'GET'):
+                body = registry.render().encode('utf8')
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                             b'Content-Length: %d\r\nConnection: close\r\n\r\n' % len(body) + body)
+            else:
+                writer.write(b'HTTP/1.1 405 Method Not Allowed\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info(f'Serving metrics on http://{host}:{server.sockets[0].getsockname()[1]}/metrics')
+    return server
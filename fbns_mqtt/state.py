@@ -0,0 +1,78 @@
+import os
+import json
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+def atomic_write(path, data):
+    """Write `data` (bytes) to a temporary file then rename it over `path`, readers see the old or the new file, never half of one"""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class FBNSState(object):
+    """FBNS auth and push token of an account, stored as versioned JSON.
+
+    Datetimes are kept as ISO strings on disk, nothing is ever unpickled, and
+    `save` only touches the disk when something changed since the last write.
+    Only FIELDS are loaded and saved, whatever else ends up in `data`.
+    """
+
+    VERSION = 1
+    FIELDS = ('fbns_auth', 'fbns_auth_received', 'fbns_token', 'fbns_token_received')
+    DATETIME_FIELDS = ('fbns_auth_received', 'fbns_token_received')
+
+    def __init__(self, path):
+        self.path = path
+        self.data = {}
+        self._written = None
+
+    def load(self):
+        self.data = {}
+        if not os.path.exists(self.path):
+            return self.data
+
+        try:
+            with open(self.path, 'rb') as f:
+                raw = f.read()
+            stored = json.loads(raw)
+
+            if stored.get('version') != self.VERSION:
+                raise ValueError(f'unsupported version {stored.get("version")}')
+
+            data = {field: value for field, value in stored.get('data', {}).items() if field in self.FIELDS}
+            for field in self.DATETIME_FIELDS:
+                if data.get(field):
+                    data[field] = datetime.fromisoformat(data[field])
+
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            # A new FBNS auth will be negotiated on connect
+            logger.warning(f'Ignoring unreadable FBNS state {self.path}: {e!r}')
+            return self.data
+
+        self.data = data
+        self._written = raw
+        return self.data
+
+    def dumps(self):
+        data = {field: value for field, value in self.data.items() if field in self.FIELDS}
+        for field in self.DATETIME_FIELDS:
+            if isinstance(data.get(field), datetime):
+                data[field] = data[field].isoformat()
+
+        return json.dumps({'version': self.VERSION, 'data': data}, separators=(',', ':'), sort_keys=True).encode('utf8')
+
+    def save(self):
+        raw = self.dumps()
+        if raw == self._written:
+            return False
+
+        atomic_write(self.path, raw)
+        self._written = raw
+        return True
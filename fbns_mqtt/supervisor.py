@@ -0,0 +1,145 @@
+import time
+import random
+import asyncio
+
+from gmqtt.client import logger
+
+from .metrics import REGISTRY
+
+RECONNECTS = REGISTRY.counter('fbns_reconnects_total', 'Connections established again after a disconnect')
+CONNECT_FAILURES = REGISTRY.counter('fbns_connect_failures_total', 'Connection attempts which failed')
+RECONNECT_SECONDS = REGISTRY.histogram('fbns_time_to_reconnect_seconds', 'Time from a disconnect to the next connection')
+
+
+class ConnectionSupervisor(object):
+    """Owns the FBNS client lifecycle: connects, waits for a disconnect, reconnects.
+
+    A fresh client is built through `client_factory` for every connection,
+    reconnects are spaced with jittered exponential backoff and only one
+    connection attempt is ever in flight.
+    """
+
+    def __init__(self, client_factory, host, port=443, ssl=True, keepalive=900,
+                 min_delay=1.0, max_delay=300.0, stable_after=60.0, connect_timeout=30.0):
+        self.client_factory = client_factory
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self.keepalive = keepalive
+
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.stable_after = stable_after
+        self.connect_timeout = connect_timeout
+
+        self.client = None
+        self.connected = asyncio.Event()
+
+        self.reconnects = 0
+        self.connect_failures = 0
+        self.last_time_to_reconnect = None
+
+        self._attempt = 0
+        self._connect_lock = asyncio.Lock()
+        self._disconnected = asyncio.Event()
+        self._stopping = False
+
+    def backoff(self):
+        delay = min(self.max_delay, self.min_delay * (2 ** self._attempt))
+        return random.uniform(delay / 2, delay)
+
+    def _on_disconnect(self, *args, **kwargs):
+        if not self._stopping:
+            self._disconnected.set()
+
+    def reconnect(self):
+        """Drop the current connection and start over"""
+        self._disconnected.set()
+
+    async def _sleep(self, delay, stop):
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _connect(self):
+        async with self._connect_lock:
+            client = self.client_factory()
+            client.on_disconnect = self._on_disconnect
+
+            try:
+                await asyncio.wait_for(
+                    client.connect(self.host, self.port, ssl=self.ssl, keepalive=self.keepalive),
+                    timeout=self.connect_timeout
+                )
+            except Exception:
+                self._stopping = True # half open client, its disconnect is not a real one
+                await self._close(client)
+                self._stopping = False
+                raise
+
+            return client
+
+    async def _close(self, client):
+        try:
+            await client.disconnect()
+        except Exception as e:
+            logger.debug(f'[SUPERVISOR] Error while closing client: {e!r}')
+
+    async def run(self, stop):
+        disconnected_at = None
+
+        while not stop.is_set():
+            self._disconnected.clear()
+            try:
+                self.client = await self._connect()
+            except Exception as e:
+                self.connect_failures += 1
+                CONNECT_FAILURES.inc()
+                delay = self.backoff()
+                self._attempt += 1
+                logger.warning(f'[SUPERVISOR] Connection failed ({e!r}), retrying in {delay:.1f}s')
+                await self._sleep(delay, stop)
+                continue
+
+            connected_at = time.monotonic()
+            self.connected.set()
+            if disconnected_at is not None:
+                self.reconnects += 1
+                self.last_time_to_reconnect = connected_at - disconnected_at
+                RECONNECTS.inc()
+                RECONNECT_SECONDS.observe(self.last_time_to_reconnect)
+                logger.info(f'[SUPERVISOR] Reconnected in {self.last_time_to_reconnect:.1f}s (#{self.reconnects})')
+
+            waiters = [asyncio.ensure_future(stop.wait()), asyncio.ensure_future(self._disconnected.wait())]
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+            for waiter in waiters:
+                waiter.cancel()
+
+            self.connected.clear()
+            if stop.is_set():
+                break
+
+            disconnected_at = time.monotonic()
+            if disconnected_at - connected_at >= self.stable_after:
+                # The connection held, start the backoff over
+                self._attempt = 0
+
+            await self._close(self.client)
+
+            delay = self.backoff()
+            self._attempt += 1
+            logger.warning(f'[SUPERVISOR] Disconnected.. Reconnecting in {delay:.1f}s')
+            await self._sleep(delay, stop)
+
+        self._stopping = True
+        if self.client:
+            await self._close(self.client)
+
+    @property
+    def metrics(self):
+        return {
+            "reconnects": self.reconnects,
+            "connect_failures": self.connect_failures,
+            "last_time_to_reconnect": self.last_time_to_reconnect
+        }
@@ -1,6 +1,7 @@
-import json
 from urllib.parse import urlsplit, parse_qs
 
+from fbns_mqtt import codec
+
 # The following events are emitted.
 
 #   Posts:
@@ -136,7 +137,7 @@ def _spop(d, k):
 class BadgeCount(object):
     def __init__(self, data):
         if isinstance(data,str):
-            data = json.loads(data)
+            data = codec.loads(data)
         self.direct = _spop(data, 'di')
         self.ds = _spop(data, 'ds')
         self.td = _spop(data, 'dt')
@@ -145,77 +146,131 @@ class BadgeCount(object):
             raise Exception('BadgeCount unexpected data: {data}'.format(**locals()))
 
 
+class _Field(object):
+    """Notification attribute read from the raw payload only when accessed"""
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return obj._data.get(self.key)
+
+
+_MISSING = object()
+
+
 class InstagramNotification(object):
+    # Decoded up front, everything needed to route a push
+    __slots__ = ('_data', 'collapseKey', 'pushCategory', 'message', 'sourceUserId', 'igAction',
+                 '_actionPath', '_actionParams', '_badgeCount')
+
+    FIELDS = {
+        'title': 't',
+        'tickerText': 'tt',
+        'optionalImage': 'i',
+        'optionalAvatarUrl': 'a',
+        'sound': 'sound',
+        'pushId': 'pi',
+        # Идентификатор чей пост прокомментировали
+        'intendedRecipientUserId': 'u',
+        'igActionOverride': 'igo',
+        'inAppActors': 'ia',
+        'suppressBadge': 'SuppressBadge',
+
+        'it': 'it',
+        'si': 'si',
+        'badge': 'badge',
+
+        'cc': 'cc',
+        'sender_app_id': 'sender_app_id',
+        'gid': 'gid',
+        'ndf': 'ndf',
+        'time_to_live': 'time_to_live',
+        'messaging_source_tag': 'messaging_source_tag',
+        'push_phase': 'push_phase',
+        'network_classification': 'network_classification',
+        'exp': 'exp',
+
+        'a_fbid': 'a_fbid',
+        'a_url': 'a_url',
+        'a_t': 'a_t',
+        'mw': 'mw',
+        'tp': 'tp',
+        'ts': 'ts',
+        'n': 'n',
+
+        'ac': 'ac',
+    }
+    KNOWN_KEYS = frozenset(FIELDS.values()) | {'collapse_key', 'c', 'm', 's', 'ig', 'bc', 'PushNotifID'}
+
     def __str__(self):
-        return str(self.__dict__)
+        return str(self.as_dict())
 
     def __init__(self, data):
         if isinstance(data, str):
-            data = json.loads(data)
+            data = codec.loads(data)
+
+        # Kept as is, no copy: other fields are read from it on access
+        self._data = data
 
-        # For sentry debug
-        original_data = dict(data)
+        self.collapseKey = data.get('collapse_key')
+        self.pushCategory = data.get('c')
+        self.message = data.get('m')
+        self.sourceUserId = data.get('s')
+        self.igAction = data.get('ig')
 
-        self.title = _spop(data, 't')
-        self.message = _spop(data, 'm')
-        self.tickerText = _spop(data, 'tt')
+        self._actionPath = _MISSING
+        self._actionParams = _MISSING
+        self._badgeCount = _MISSING
 
-        self.igAction = _spop(data, 'ig')
-        self.actionPath = None
-        self.actionParams = None
+    def _parse_action(self):
+        self._actionPath = None
+        self._actionParams = None
 
         if self.igAction:
             scheme, netloc, path, query_string, fragment = urlsplit(self.igAction)
             query_params = parse_qs(query_string)
             query_params = dict((k, v if len(v) > 1 else v[0]) for k, v in query_params.items())
             if path:
-                self.actionPath = path
+                self._actionPath = path
             if query_params:
-                self.actionParams = query_params
+                self._actionParams = query_params
 
-        self.collapseKey = _spop(data, 'collapse_key')
-        self.optionalImage = _spop(data, 'i')
-        self.optionalAvatarUrl = _spop(data, 'a')
-        self.sound = _spop(data, 'sound')
-        self.pushId = _spop(data, 'pi')
-        if 'PushNotifID' in data:
-            _spop(data, 'PushNotifID')
+    @property
+    def actionPath(self):
+        if self._actionPath is _MISSING:
+            self._parse_action()
+        return self._actionPath
 
-        self.pushCategory = _spop(data, 'c')
+    @property
+    def actionParams(self):
+        if self._actionParams is _MISSING:
+            self._parse_action()
+        return self._actionParams
 
-        # Идентификатор чей пост прокомментировали
-        self.intendedRecipientUserId = _spop(data, 'u')
-        self.sourceUserId = _spop(data, 's')
-        self.igActionOverride = _spop(data, 'igo')
-        self.badgeCount = _spop(data, 'bc')
-        if self.badgeCount:
-            self.badgeCount = BadgeCount(self.badgeCount)
-        self.inAppActors = _spop(data, 'ia')
-        self.suppressBadge = _spop(data, 'SuppressBadge')
-
-        self.it = _spop(data, 'it')
-        self.si = _spop(data, 'si')
-        self.badge = _spop(data, 'badge')
-
-        self.cc = _spop(data, 'cc') 
-        self.sender_app_id = _spop(data, 'sender_app_id') 
-        self.gid = _spop(data, 'gid') 
-        self.ndf = _spop(data, 'ndf') 
-        self.time_to_live = _spop(data, 'time_to_live') 
-        self.messaging_source_tag = _spop(data, 'messaging_source_tag') 
-        self.push_phase = _spop(data, 'push_phase') 
-        self.network_classification = _spop(data, 'network_classification') 
-        self.exp = _spop(data, 'exp')
-
-        self.a_fbid = _spop(data, 'a_fbid')
-        self.a_url = _spop(data, 'a_url')
-        self.a_t = _spop(data, 'a_t')
-        self.mw = _spop(data, 'mw')
-        self.tp = _spop(data, 'tp')
-        self.ts = _spop(data, 'ts')
-        self.n = _spop(data, 'n')
-
-        self.ac = _spop(data, 'ac')
+    @property
+    def badgeCount(self):
+        if self._badgeCount is _MISSING:
+            badge_count = self._data.get('bc')
+            if isinstance(badge_count, dict):
+                badge_count = dict(badge_count) # BadgeCount consumes what it is given
+            self._badgeCount = BadgeCount(badge_count) if badge_count else None
+        return self._badgeCount
 
-        if data:
-            raise Exception('InstagramNotification unexpected data: {data}'.format(**locals()))
+    @property
+    def unexpectedKeys(self):
+        return set(self._data) - self.KNOWN_KEYS
+
+    def as_dict(self):
+        d = {name: getattr(self, name) for name in ('collapseKey', 'pushCategory', 'message', 'sourceUserId', 'igAction',
+                                                    'actionPath', 'actionParams')}
+        d.update((name, getattr(self, name)) for name in self.FIELDS)
+        d['badgeCount'] = self.badgeCount.__dict__ if self.badgeCount else None
+        return d
+
+
+for _name, _key in InstagramNotification.FIELDS.items():
+    setattr(InstagramNotification, _name, _Field(_key))
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+
+from dedup import DedupWindow
+from sender import TokenBucket, call
+from fbns_mqtt.metrics import REGISTRY
+
+APPROVALS = REGISTRY.counter('qfbot_pending_approvals_total', 'Pending threads approved, by outcome', ('result',))
+
+
+class PendingSweeper(object):
+	"""Approves message requests in the background, in batches.
+
+	`note(thread_id)` only records a pending push, the inbox is swept
+	`debounce` seconds later (and every `interval` seconds anyway, for the
+	requests whose push was missed) so a burst of pending pushes ends up in a
+	single pending inbox fetch and a few `approve(thread_ids)` calls of
+	`batch_size` threads. Approved threads are remembered for a day and
+	welcomed through `welcome(thread_id)`, at most `welcome_rate` per second.
+
+	`fetch_pending()` returns the pending thread ids. `fetch_pending` and
+	`approve` can be coroutine functions or blocking calls run in the thread
+	pool.
+	"""
+
+	def __init__(self, fetch_pending, approve, welcome, interval=300.0, debounce=5.0, batch_size=20,
+			welcome_rate=0.05, welcome_burst=3, max_welcomes=100, executor=None):
+		self.fetch_pending = fetch_pending
+		self.approve = approve
+		self.welcome = welcome
+
+		self.interval = interval
+		self.debounce = debounce
+		self.batch_size = batch_size
+		self.executor = executor
+
+		self.welcome_bucket = TokenBucket(welcome_rate, welcome_burst)
+		self.max_welcomes = max_welcomes
+
+		self.approved = DedupWindow(capacity=4096, ttl=86400)
+		self.sweeps = 0
+		self.noted = 0
+		self.duplicates = 0
+		self.approvals = 0
+		self.failures = 0
+		self.welcomed = 0
+		self.welcomes_dropped = 0
+
+		self._wanted = set()
+		self._wake = asyncio.Event()
+		self._wake_scheduled = False
+		self._welcomes = asyncio.Queue()
+
+	def note(self, thread_id):
+		thread_id = str(thread_id)
+		if thread_id in self._wanted or thread_id in self.approved:
+			# Every message of a request comes with its own pending push
+			self.duplicates += 1
+			return
+
+		self.noted += 1
+		self._wanted.add(thread_id)
+		if not self._wake_scheduled:
+			self._wake_scheduled = True
+			asyncio.get_event_loop().call_later(self.debounce, self._wake.set)
+
+	async def sweep(self):
+		self.sweeps += 1
+		wanted, self._wanted = self._wanted, set()
+
+		try:
+			wanted.update(str(thread_id) for thread_id in await call(self.executor, self.fetch_pending))
+		except Exception as e:
+			# Still approve the threads pushes told us about
+			logging.warning(f"Could not fetch pending inbox: {e!r}")
+
+		wanted = [thread_id for thread_id in wanted if thread_id not in self.approved]
+		for i in range(0, len(wanted), self.batch_size):
+			batch = wanted[i:i + self.batch_size]
+			try:
+				await call(self.executor, self.approve, batch)
+			except Exception as e:
+				self.failures += len(batch)
+				APPROVALS.inc('failed', amount=len(batch))
+				logging.error(f"Could not approve {len(batch)} pending threads: {e!r}")
+				# Tried again on the next sweep
+				self._wanted.update(batch)
+				continue
+
+			self.approvals += len(batch)
+			APPROVALS.inc('approved', amount=len(batch))
+			for thread_id in batch:
+				self.approved.seen(thread_id)
+				self._queue_welcome(thread_id)
+
+		if wanted:
+			logging.info(f"Approved {self.approvals} pending threads so far ({len(wanted)} this sweep)")
+
+	def _queue_welcome(self, thread_id):
+		if self._welcomes.qsize() >= self.max_welcomes:
+			self.welcomes_dropped += 1
+			return
+		self._welcomes.put_nowait(thread_id)
+
+	async def _welcomer(self):
+		while True:
+			thread_id = await self._welcomes.get()
+			await self.welcome_bucket.acquire()
+			self.welcomed += 1
+			self.welcome(thread_id)
+
+	async def run(self, stop):
+		welcomer = asyncio.ensure_future(self._welcomer())
+		stopped = asyncio.ensure_future(stop.wait())
+
+		try:
+			while True:
+				wake = asyncio.ensure_future(self._wake.wait())
+				await asyncio.wait([wake, stopped], timeout=self.interval, return_when=asyncio.FIRST_COMPLETED)
+				wake.cancel()
+
+				if stop.is_set():
+					break
+
+				self._wake.clear()
+				self._wake_scheduled = False
+				await self.sweep()
+
+		finally:
+			welcomer.cancel()
+			stopped.cancel()
+			await asyncio.gather(welcomer, stopped, return_exceptions=True)
+
+	@property
+	def metrics(self):
+		return {
+			"pending_sweeps": self.sweeps,
+			"pending_noted": self.noted,
+			"pending_duplicates": self.duplicates,
+			"pending_approved": self.approvals,
+			"pending_failed": self.failures,
+			"welcomed": self.welcomed,
+			"welcomes_dropped": self.welcomes_dropped
+		}
@@ -0,0 +1,213 @@
+import sqlite3
+import asyncio
+import logging
+import threading
+
+from collections import OrderedDict
+
+
+class PreferenceStore(object):
+	"""Language preference of users and threads, kept in SQLite (WAL mode).
+
+	Writes are kept in memory (and served from there) until `run_flusher`
+	writes them to disk in batches, each batch in a single transaction so a
+	crash never leaves half of it behind. Hot reads are cached by
+	PreferenceResolver, not here.
+	"""
+
+	def __init__(self, path, flush_interval=2.0, max_pending=256):
+		self.path = path
+		self.flush_interval = flush_interval
+		self.max_pending = max_pending
+
+		self.flushes = 0
+		self.flushed = 0
+
+		self._lock = threading.Lock()
+		self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+		self._db.execute("PRAGMA journal_mode=WAL")
+		self._db.execute("PRAGMA synchronous=NORMAL")
+		self._db.execute("CREATE TABLE IF NOT EXISTS languages (key TEXT PRIMARY KEY, lang TEXT NOT NULL)")
+
+		# Only touched on the loop thread, the executor is handed a batch
+		self._dirty = {}
+		self._flushing = {} # batch being written, still served by get()
+		self._flush_now = None
+
+	def get(self, key):
+		if key is None:
+			return None
+
+		key = str(key)
+		lang = self._dirty.get(key) or self._flushing.get(key)
+		if lang is not None:
+			return lang
+
+		with self._lock:
+			row = self._db.execute("SELECT lang FROM languages WHERE key = ?", (key,)).fetchone()
+
+		return row[0] if row else None
+
+	def set(self, key, lang):
+		self._dirty[str(key)] = lang
+
+		if len(self._dirty) >= self.max_pending and self._flush_now:
+			self._flush_now.set()
+
+	def update(self, prefs):
+		for key, lang in prefs.items():
+			self.set(key, lang)
+
+	def _write(self, batch):
+		with self._lock:
+			try:
+				self._db.execute("BEGIN")
+				self._db.executemany(
+					"INSERT INTO languages (key, lang) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET lang = excluded.lang",
+					list(batch.items())
+				)
+				self._db.execute("COMMIT")
+
+			except sqlite3.Error:
+				self._db.execute("ROLLBACK")
+				raise
+
+	def _written(self, batch, error=None):
+		self._flushing = {}
+		if error is not None:
+			# Put the batch back unless newer values came in meanwhile
+			for key, lang in batch.items():
+				self._dirty.setdefault(key, lang)
+			return
+
+		self.flushes += 1
+		self.flushed += len(batch)
+
+	def flush(self):
+		"""Blocking flush, for when the flusher is not running"""
+		batch, self._dirty = self._dirty, {}
+		if not batch:
+			return 0
+
+		try:
+			self._write(batch)
+		except sqlite3.Error as e:
+			self._written(batch, e)
+			raise
+
+		self._written(batch)
+		return len(batch)
+
+	async def flush_async(self, loop):
+		# Swapped here on the loop thread, only the SQLite write goes to the executor
+		batch, self._dirty = self._dirty, {}
+		if not batch:
+			return 0
+
+		self._flushing = batch
+		try:
+			await loop.run_in_executor(None, self._write, batch)
+		except sqlite3.Error as e:
+			self._written(batch, e)
+			raise
+
+		self._written(batch)
+		return len(batch)
+
+	async def run_flusher(self, stop):
+		"""Write-behind loop, flushes every `flush_interval` seconds (or sooner when many writes pile up) until `stop` is set"""
+		loop = asyncio.get_event_loop()
+		self._flush_now = asyncio.Event()
+
+		while not stop.is_set():
+			try:
+				await asyncio.wait_for(self._flush_now.wait(), timeout=self.flush_interval)
+			except asyncio.TimeoutError:
+				pass
+			self._flush_now.clear()
+
+			try:
+				await self.flush_async(loop)
+			except sqlite3.Error as e:
+				logging.error(f"Could not save language preferences: {e!r}")
+
+		await self.flush_async(loop)
+
+	def close(self):
+		self.flush()
+		with self._lock:
+			self._db.close()
+
+	@property
+	def metrics(self):
+		return {
+			"prefs_pending": len(self._dirty),
+			"prefs_flushes": self.flushes,
+			"prefs_flushed": self.flushed
+		}
+
+
+class PreferenceResolver(object):
+	"""Language of a (thread, author) pair: the thread's, else the author's, else `default`.
+
+	Resolutions are kept in a bounded LRU so busy threads never hit the store,
+	and every cached pair is indexed by both of its ids so setting a language
+	only evicts the pairs it can change.
+	"""
+
+	def __init__(self, store, default="fr", size=4096):
+		self.store = store
+		self.default = default
+		self.size = size
+
+		self.hits = 0
+		self.misses = 0
+
+		self._cache = OrderedDict() # (thread_id, user_id) -> lang
+		self._by_id = {} # thread_id or user_id -> {(thread_id, user_id), ..}
+
+	def resolve(self, thread_id, user_id):
+		pair = (str(thread_id), str(user_id))
+
+		lang = self._cache.get(pair)
+		if lang is not None:
+			self.hits += 1
+			self._cache.move_to_end(pair)
+			return lang
+
+		self.misses += 1
+		lang = self.store.get(thread_id) or self.store.get(user_id) or self.default
+
+		self._cache[pair] = lang
+		for key in pair:
+			self._by_id.setdefault(key, set()).add(pair)
+
+		if len(self._cache) > self.size:
+			self._forget(next(iter(self._cache)))
+
+		return lang
+
+	def _forget(self, pair):
+		self._cache.pop(pair, None)
+		for key in pair:
+			pairs = self._by_id.get(key)
+			if pairs is not None:
+				pairs.discard(pair)
+				if not pairs:
+					del self._by_id[key]
+
+	def invalidate(self, key):
+		for pair in list(self._by_id.get(str(key), ())):
+			self._forget(pair)
+
+	def set(self, key, lang):
+		self.store.set(key, lang)
+		self.invalidate(key)
+
+	@property
+	def metrics(self):
+		return {
+			"lang_cache_size": len(self._cache),
+			"lang_cache_hits": self.hits,
+			"lang_cache_misses": self.misses
+		}
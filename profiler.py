@@ -0,0 +1,175 @@
+import os
+import sys
+import signal
+import time
+import asyncio
+import logging
+import threading
+import traceback
+
+from collections import Counter
+
+from fbns_mqtt.metrics import REGISTRY
+from fbns_mqtt.state import atomic_write
+
+LOOP_STALLS = REGISTRY.counter('qfbot_loop_stalls_total', 'Times the event loop was blocked longer than the watchdog threshold')
+LOOP_LAG = REGISTRY.histogram('qfbot_loop_lag_seconds', 'How late the watchdog heartbeat woke up')
+
+
+def _frame_label(frame):
+	code = frame.f_code
+	return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def fold_stack(frame, root):
+	"""`root;outer;..;inner`, the folded format read by flamegraph.pl and speedscope"""
+	labels = []
+	while frame is not None:
+		labels.append(_frame_label(frame))
+		frame = frame.f_back
+
+	labels.append(root)
+	return ';'.join(reversed(labels))
+
+
+class StackSampler(object):
+	"""Samples the stack of every thread (event loop and thread pools) from a
+	background thread, without restarting or slowing the bot when idle.
+
+	Each run lasts `duration` seconds and ends up in `directory` as a
+	`.folded` file, one `stack count` line per distinct stack.
+	"""
+
+	def __init__(self, directory="profiles", interval=0.005, duration=30.0):
+		self.directory = directory
+		self.interval = interval
+		self.duration = duration
+
+		self.last_file = None
+		self._thread = None
+		self._stop = threading.Event()
+
+	@property
+	def running(self):
+		return self._thread is not None and self._thread.is_alive()
+
+	def start(self, duration=None):
+		if self.running:
+			return False
+
+		self._stop.clear()
+		self._thread = threading.Thread(target=self._run, args=(duration or self.duration,), name="stack-sampler", daemon=True)
+		self._thread.start()
+		return True
+
+	def stop(self):
+		self._stop.set()
+
+	def toggle(self):
+		"""Signal handler friendly: start a capture, or end the running one early"""
+		if self.running:
+			self.stop()
+		else:
+			self.start()
+
+	def _run(self, duration):
+		own = threading.get_ident()
+		stacks = Counter()
+		samples = 0
+
+		logging.info(f"Profiling for {duration:.0f}s")
+		started = time.monotonic()
+		while not self._stop.is_set() and time.monotonic() - started < duration:
+			names = {thread.ident: thread.name for thread in threading.enumerate()}
+			for ident, frame in sys._current_frames().items():
+				if ident != own:
+					stacks[fold_stack(frame, names.get(ident, str(ident)))] += 1
+			samples += 1
+
+			self._stop.wait(self.interval)
+
+		self.last_file = self.write(stacks)
+		logging.info(f"Profile of {samples} samples written to {self.last_file}")
+
+	def write(self, stacks):
+		os.makedirs(self.directory, exist_ok=True)
+		path = os.path.join(self.directory, time.strftime(f"qfbot-{os.getpid()}-%Y%m%d-%H%M%S.folded"))
+		data = ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+		atomic_write(path, data.encode('utf8'))
+		return path
+
+
+class LoopWatchdog(object):
+	"""Flags anything blocking the event loop for more than `threshold` seconds.
+
+	A heartbeat task ticks on the loop while a watchdog thread checks it
+	keeps ticking, when it does not the loop thread stack is logged while it
+	is still blocked, pointing right at the offending call.
+	"""
+
+	def __init__(self, threshold=0.1):
+		self.threshold = threshold
+		self.interval = threshold / 2
+
+		self.stalls = 0
+
+		self._beat = time.monotonic()
+		self._reported = None
+		self._loop_thread = None
+		self._task = None
+		self._thread = None
+		self._stop = threading.Event()
+
+	def start(self):
+		self._loop_thread = threading.get_ident()
+		self._beat = time.monotonic()
+		self._stop.clear()
+
+		self._task = asyncio.ensure_future(self._heartbeat())
+		self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+		self._thread.start()
+
+	def stop(self):
+		self._stop.set()
+		if self._task:
+			self._task.cancel()
+			self._task = None
+
+	async def _heartbeat(self):
+		while True:
+			self._beat = time.monotonic()
+			await asyncio.sleep(self.interval)
+
+			lag = time.monotonic() - self._beat - self.interval
+			LOOP_LAG.observe(max(0.0, lag))
+			if lag > self.threshold:
+				logging.warning(f"Event loop was blocked for {lag*1000:.0f}ms")
+
+	def _watch(self):
+		while not self._stop.wait(self.interval):
+			beat = self._beat
+			if time.monotonic() - beat - self.interval <= self.threshold or self._reported == beat:
+				continue
+
+			# Once per stall, the loop is still stuck in there
+			self._reported = beat
+			self.stalls += 1
+			LOOP_STALLS.inc()
+
+			frame = sys._current_frames().get(self._loop_thread)
+			if frame is not None:
+				stack = ''.join(traceback.format_stack(frame, limit=12))
+				logging.warning(f"Event loop blocked for more than {self.threshold*1000:.0f}ms, in:\n{stack}")
+
+
+def install(loop, directory="profiles", duration=30.0, slow_threshold=0.1, sig=None):
+	"""Start the watchdog on `loop` and profile on `sig` (SIGUSR1 by default), returns (sampler, watchdog)"""
+	sampler = StackSampler(directory, duration=duration)
+	loop.add_signal_handler(sig or signal.SIGUSR1, sampler.toggle)
+
+	watchdog = None
+	if slow_threshold:
+		watchdog = LoopWatchdog(slow_threshold)
+		loop.call_soon(watchdog.start)
+
+	return sampler, watchdog
@@ -0,0 +1,193 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+import unicodedata
+
+from functools import lru_cache
+from types import MappingProxyType
+
+
+# Only the end of a message can match, this is how much of it gets normalized
+TAIL_LEN = 64
+
+# Keys shorter than this only match whole words, so "a" does not fire on every word ending with an "a"
+# while longer ones also match as a word ending ("pourquoi" -> "quoi")
+SUFFIX_MIN_LEN = 4
+
+_TERMINAL = None
+
+
+_NON_WORD = re.compile(r'[\W_]+')
+_REPEATED = re.compile(r'(.)\1+')
+
+
+def normalize(text):
+	"""Fold accents and case, drop punctuation and emojis, collapse repeated letters ("Quoiiii ?!" -> "quoi")"""
+	text = unicodedata.normalize('NFKD', text)
+	text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+	text = _NON_WORD.sub(' ', text.casefold())
+	text = _REPEATED.sub(r'\1', text)
+
+	return ' '.join(text.split())
+
+
+@lru_cache(maxsize=4096)
+def normalize_tail(tail, cut=False):
+	"""normalize() the last TAIL_LEN characters of a message, `cut` when it was longer.
+	Cached by tail, as the same endings tend to come in bursts"""
+	if cut:
+		# '#' is never part of a key, the cut is not seen as a word boundary
+		return '#' + normalize(tail)
+	return normalize(tail)
+
+
+class SuffixMatcher(object):
+	"""Reversed trie of every key of a language.
+
+	Walking it from the end of a message finds the longest key the message
+	ends with, in at most len(message) steps whatever the dictionary size.
+	"""
+
+	def __init__(self, words):
+		self.root = {}
+		self.size = 0
+
+		for word, pwords in words.items():
+			key = normalize(word)
+			if not key:
+				continue
+
+			node = self.root
+			for ch in reversed(key):
+				node = node.setdefault(ch, {})
+
+			if _TERMINAL in node:
+				# Keys which only differ by accents or repeated letters share their puns
+				word, pwords = node[_TERMINAL][0], node[_TERMINAL][1] + pwords
+			else:
+				self.size += 1
+
+			node[_TERMINAL] = (word, pwords)
+
+	def match(self, text):
+		"""Return (key, puns) for the longest key `text` ends with, or None"""
+		best = None
+		node = self.root
+
+		for i in range(len(text) - 1, -1, -1):
+			node = node.get(text[i])
+			if node is None:
+				break
+
+			found = node.get(_TERMINAL)
+			if found and (i == 0 or text[i-1] == ' ' or len(text) - i >= SUFFIX_MIN_LEN):
+				best = found
+
+		return best
+
+
+class PunIndex(object):
+	"""Loaded-once view of puns.json, reloaded only when the file changes on disk.
+
+	The table is a read-only mapping of language -> {word: (pun, ...)} and is
+	rebuilt off to the side then swapped in with a single assignment, so a
+	lookup never sees a half-built table.
+	"""
+
+	def __init__(self, path='puns.json', check_interval=1.0):
+		self.path = path
+		self.check_interval = check_interval
+
+		self.reload_count = 0
+		self.last_parse_time = 0.0
+
+		self._lock = threading.Lock()
+		self._signature = None
+		self._next_check = 0.0
+		self._state = (MappingProxyType({}), {})
+
+		self.reload()
+
+	def _stat_signature(self):
+		try:
+			st = os.stat(self.path)
+		except FileNotFoundError:
+			return None
+
+		return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+	def _build(self, raw):
+		table = MappingProxyType({
+			lang: MappingProxyType({word: tuple(pwords) for word, pwords in words.items()})
+			for lang, words in raw.items()
+		})
+		matchers = {lang: SuffixMatcher(words) for lang, words in table.items()}
+
+		return table, matchers
+
+	def reload(self, force=False):
+		with self._lock:
+			signature = self._stat_signature()
+			if signature == self._signature and not force:
+				return False
+
+			start = time.perf_counter()
+			try:
+				with open(self.path, 'r', encoding='utf8') as f:
+					state = self._build(json.load(f))
+			except (OSError, ValueError) as e:
+				# Keep serving the previous table, a half-saved file will be picked up on next change
+				logging.warning(f"Could not load {self.path}: {e}")
+				self._signature = signature
+				return False
+
+			self.last_parse_time = time.perf_counter() - start
+			self.reload_count += 1
+
+			self._signature = signature
+			self._state = state
+
+		logging.info(f"Loaded {self.path} ({self.last_parse_time*1000:.2f}ms, reload #{self.reload_count})")
+		return True
+
+	def maybe_reload(self):
+		now = time.monotonic()
+		if now < self._next_check:
+			return
+
+		self._next_check = now + self.check_interval
+		self.reload()
+
+	@property
+	def table(self):
+		self.maybe_reload()
+		return self._state[0]
+
+	def get(self, lang):
+		return self.table.get(lang)
+
+	def match(self, lang, text):
+		"""Longest pun key `text` ends with for `lang`, as (key, puns), or None"""
+		self.maybe_reload()
+
+		matcher = self._state[1].get(lang)
+		if matcher is None:
+			return None
+
+		return matcher.match(normalize_tail(text[-TAIL_LEN:], len(text) > TAIL_LEN))
+
+	def languages(self):
+		return self.table.keys()
+
+	@property
+	def metrics(self):
+		cache = normalize_tail.cache_info()
+		return {
+			"reload_count": self.reload_count,
+			"last_parse_time": self.last_parse_time,
+			"normalize_cache_hits": cache.hits,
+			"normalize_cache_misses": cache.misses
+		}
@@ -0,0 +1,312 @@
+import os
+import json
+import time
+import queue
+import bisect
+import signal
+import asyncio
+import hashlib
+import logging
+import functools
+import multiprocessing
+
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+from fbns_mqtt.metrics import serve as serve_metrics
+from api import shared_transport
+
+import profiler
+
+
+def load_accounts(path):
+	"""accounts.json: [{"username": "..", "password": ".."}, ..]"""
+	with open(path, 'r') as f:
+		accounts = json.load(f)
+
+	return [(account['username'], account['password']) for account in accounts]
+
+
+class MultiAccountRunner(object):
+	"""Runs several bot accounts in one process, on a single event loop.
+
+	Every account keeps its own settings, FBNS auth and MQTT connection while
+	they share the pun index, the HTTP connection pool and the reply threads.
+	"""
+
+	def __init__(self, bot_factory, accounts, workers=8, pool_size=16):
+		self.bot_factory = bot_factory
+		self.accounts = list(accounts)
+
+		# Connections are pooled by host in the adapters, cookies stay in every account's own session.
+		# One per instagrapi session kind, the bots set their retry policies when mounting them
+		self.http_adapters = {
+			'private': HTTPAdapter(pool_connections=4, pool_maxsize=pool_size),
+			'public': HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+		}
+		# Same for the async private API, None without httpx
+		self.http_transport = shared_transport(pool_size)
+		self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="reply")
+
+		self.bots = {}
+		self.tasks = {}
+
+	async def start_account(self, username, password):
+		if username in self.tasks:
+			return self.bots[username]
+
+		loop = asyncio.get_event_loop()
+
+		# Logging in is a blocking instagrapi call, other accounts keep running meanwhile
+		bot = await loop.run_in_executor(None, functools.partial(
+			self.bot_factory, username, password,
+			settings_path=f"sessions/{username}_settings.json",
+			stop=asyncio.Event(),
+			executor=self.executor,
+			http_adapters=self.http_adapters,
+			http_transport=self.http_transport
+		))
+
+		self.bots[username] = bot
+		self.tasks[username] = asyncio.ensure_future(bot.listener_worker())
+		self.tasks[username].add_done_callback(functools.partial(self._on_done, username))
+
+		logging.info(f"[{username}] Started")
+		return bot
+
+	def _on_done(self, username, task):
+		if not task.cancelled() and task.exception():
+			logging.error(f"[{username}] Stopped on error: {task.exception()!r}")
+
+		self.tasks.pop(username, None)
+		self.bots.pop(username, None)
+
+	async def stop_account(self, username):
+		bot, task = self.bots.get(username), self.tasks.get(username)
+		if bot is None:
+			return
+
+		bot.stop_event.set()
+		await asyncio.gather(task, return_exceptions=True)
+
+		logging.info(f"[{username}] Stopped")
+
+	async def stop(self):
+		await asyncio.gather(*(self.stop_account(username) for username in list(self.bots)))
+
+	@property
+	def metrics(self):
+		return {username: bot.metrics for username, bot in self.bots.items()}
+
+	async def run(self, stop=None):
+		for username, password in self.accounts:
+			try:
+				await self.start_account(username, password)
+			except Exception as e:
+				logging.error(f"[{username}] Could not start: {e!r}")
+
+		if stop is not None:
+			await stop.wait()
+			await self.stop()
+
+		else:
+			while self.tasks:
+				await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+
+		if self.http_transport is not None:
+			await self.http_transport.aclose()
+		self.executor.shutdown(wait=False)
+
+
+class HashRing(object):
+	"""Consistent hashing of account names over worker slots, changing the number of
+	workers only moves the accounts of the slots added or removed"""
+
+	def __init__(self, nodes, vnodes=64):
+		self._ring = sorted(
+			(self._hash(f"{node}:{i}"), node)
+			for node in nodes for i in range(vnodes)
+		)
+		self._keys = [h for h, _ in self._ring]
+
+	@staticmethod
+	def _hash(key):
+		return int.from_bytes(hashlib.md5(key.encode('utf8')).digest()[:8], 'big')
+
+	def node_for(self, key):
+		i = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+		return self._ring[i][1]
+
+
+def _worker_main(index, bot_factory, accounts, metrics_queue, report_interval, metrics_port=None, profiling=None):
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+
+	stop = asyncio.Event()
+	for sig in (signal.SIGINT, signal.SIGTERM):
+		loop.add_signal_handler(sig, stop.set)
+
+	runner = MultiAccountRunner(bot_factory, accounts)
+	if profiling is not None:
+		profiler.install(loop, **profiling)
+	if metrics_port:
+		loop.run_until_complete(serve_metrics(metrics_port + 1 + index))
+
+	async def report():
+		while True:
+			await asyncio.sleep(report_interval)
+			try:
+				metrics_queue.put_nowait((index, time.time(), runner.metrics))
+			except queue.Full:
+				pass
+
+	reporter = loop.create_task(report())
+	try:
+		loop.run_until_complete(runner.run(stop))
+	finally:
+		reporter.cancel()
+		loop.run_until_complete(asyncio.gather(reporter, return_exceptions=True))
+		loop.close()
+
+
+class ProcessSupervisor(object):
+	"""Spreads accounts over worker processes so matching, JSON decoding and request
+	signing of different accounts run on different cores.
+
+	Accounts are assigned to workers by consistent hashing, a worker which dies
+	is started again with the same accounts (their FBNS sessions are reloaded
+	from sessions/) and workers report their metrics back to be aggregated here.
+	"""
+
+	def __init__(self, bot_factory, accounts, processes, report_interval=30.0, max_restart_delay=60.0, metrics_port=None, profiling=None):
+		self.bot_factory = bot_factory
+		self.processes = max(1, processes)
+		self.metrics_port = metrics_port
+		self.profiling = profiling
+		self.report_interval = report_interval
+		self.max_restart_delay = max_restart_delay
+
+		ring = HashRing(range(self.processes))
+		self.assignments = {i: [] for i in range(self.processes)}
+		for username, password in accounts:
+			self.assignments[ring.node_for(username)].append((username, password))
+
+		self.metrics_queue = multiprocessing.Queue(maxsize=1024)
+		self.workers = {}
+		self.started_at = {}
+		self.restarts = {i: 0 for i in self.processes_with_accounts}
+		self.restart_at = {}
+		self.reports = {}
+
+		self._last_totals = None
+		self._stopping = False
+
+	@property
+	def processes_with_accounts(self):
+		return [i for i, accounts in self.assignments.items() if accounts]
+
+	def _start(self, index):
+		process = multiprocessing.Process(
+			target=_worker_main,
+			args=(index, self.bot_factory, self.assignments[index], self.metrics_queue, self.report_interval, self.metrics_port, self.profiling),
+			name=f"qfbot-worker-{index}",
+			daemon=True
+		)
+		process.start()
+
+		self.workers[index] = process
+		self.started_at[index] = time.monotonic()
+
+		usernames = ', '.join(username for username, _ in self.assignments[index])
+		logging.info(f"[worker {index}] Started (pid {process.pid}): {usernames}")
+
+	def _check_workers(self):
+		now = time.monotonic()
+		for index, process in list(self.workers.items()):
+			if process.is_alive():
+				continue
+
+			if index not in self.restart_at:
+				# Workers crashing right after start are restarted slower and slower
+				self.reports.pop(index, None)
+				uptime = now - self.started_at[index]
+				self.restarts[index] += 1
+				delay = 1.0 if uptime > self.max_restart_delay else min(self.max_restart_delay, 2 ** self.restarts[index])
+				self.restart_at[index] = now + delay
+				logging.error(f"[worker {index}] Exited with code {process.exitcode}, restarting in {delay:.0f}s")
+
+			elif now >= self.restart_at[index]:
+				del self.restart_at[index]
+				self._start(index)
+
+	def _collect_reports(self, timeout):
+		try:
+			index, at, metrics = self.metrics_queue.get(timeout=timeout)
+			self.reports[index] = (at, metrics)
+			while True:
+				index, at, metrics = self.metrics_queue.get_nowait()
+				self.reports[index] = (at, metrics)
+		except queue.Empty:
+			pass
+
+	def aggregate(self):
+		totals = {}
+		for index, (at, metrics) in self.reports.items():
+			for account in metrics.values():
+				for key, value in account.items():
+					if isinstance(value, (int, float)) and not isinstance(value, bool):
+						totals[key] = totals.get(key, 0) + value
+
+		totals['accounts'] = sum(len(metrics) for _, metrics in self.reports.values())
+		totals['workers_alive'] = sum(process.is_alive() for process in self.workers.values())
+		totals['worker_restarts'] = sum(self.restarts.values())
+		return totals
+
+	def _log_health(self):
+		totals = self.aggregate()
+		now = time.monotonic()
+
+		if self._last_totals:
+			at, previous = self._last_totals
+			elapsed = now - at
+			for key in ('pushes', 'sent'):
+				if key in totals and key in previous:
+					totals[f"{key}_per_sec"] = round((totals[key] - previous[key]) / elapsed, 2)
+
+		self._last_totals = (now, totals)
+		logging.info(f"[supervisor] {json.dumps(totals)}")
+
+	def stop(self):
+		self._stopping = True
+		for process in self.workers.values():
+			if process.is_alive():
+				process.terminate()
+		for process in self.workers.values():
+			process.join(timeout=10)
+
+	def _forward_signal(self, signum, frame):
+		# SIGUSR1 on the supervisor profiles every worker at once
+		for process in self.workers.values():
+			if process.is_alive():
+				os.kill(process.pid, signum)
+
+	def run(self):
+		signal.signal(signal.SIGUSR1, self._forward_signal)
+		for index in self.processes_with_accounts:
+			self._start(index)
+
+		next_health = time.monotonic() + self.report_interval
+		try:
+			while not self._stopping:
+				self._collect_reports(timeout=1.0)
+				self._check_workers()
+
+				if time.monotonic() >= next_health:
+					next_health += self.report_interval
+					self._log_health()
+
+		except KeyboardInterrupt:
+			pass
+
+		finally:
+			self.stop()
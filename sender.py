@@ -0,0 +1,300 @@
+import time
+import asyncio
+import logging
+import functools
+import contextlib
+
+from collections import Counter
+
+from concurrent.futures import ThreadPoolExecutor
+
+from fbns_mqtt.metrics import REGISTRY, SIZE_BUCKETS
+
+REPLIES = REGISTRY.counter('qfbot_replies_total', 'Replies by priority and outcome: sent, failed, dropped (queue full) or stale', ('priority', 'result'))
+SEND_SECONDS = REGISTRY.histogram('qfbot_send_seconds', 'Time to send a message')
+QUEUE_DEPTH = REGISTRY.histogram('qfbot_reply_queue_depth', 'Replies waiting when a new one is queued', buckets=SIZE_BUCKETS)
+
+# Outbound actions, most urgent first. A pun is only funny within seconds, the rest can wait
+PUN, COMMAND, WELCOME, DEBUG = range(4)
+PRIORITY_NAMES = ('pun', 'command', 'welcome', 'debug')
+DEADLINES = {PUN: 10.0, COMMAND: 60.0, WELCOME: 600.0, DEBUG: 600.0}
+
+
+async def call(executor, fn, *args, **kwargs):
+	"""Await `fn(*args, **kwargs)`, a coroutine function, or a blocking call run in `executor`"""
+	if asyncio.iscoroutinefunction(fn):
+		return await fn(*args, **kwargs)
+	return await asyncio.get_event_loop().run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+
+class TokenBucket(object):
+	"""Account wide send budget: `rate` tokens per second, up to `burst` at once.
+
+	acquire() callers with a lower `priority` value are served first, a
+	waiter leaves the next token alone while a more urgent one is waiting.
+	"""
+
+	def __init__(self, rate, burst):
+		self.rate = rate
+		self.burst = max(1, burst)
+
+		self._tokens = float(self.burst)
+		self._updated = time.monotonic()
+		self._waiting = Counter() # priority -> waiters
+
+	def _refill(self):
+		now = time.monotonic()
+		self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+		self._updated = now
+
+	def try_acquire(self):
+		self._refill()
+		if self._tokens >= 1:
+			self._tokens -= 1
+			return True
+		return False
+
+	def _outranked(self, priority):
+		return any(count for waiting, count in self._waiting.items() if waiting < priority)
+
+	def refund(self):
+		"""Give back a token acquired for nothing"""
+		self._tokens = min(self.burst, self._tokens + 1)
+
+	async def acquire(self, priority=0):
+		self._waiting[priority] += 1
+		try:
+			while self._outranked(priority) or not self.try_acquire():
+				await asyncio.sleep(max(0.01, (1 - self._tokens) / self.rate))
+		finally:
+			self._waiting[priority] -= 1
+
+
+class ReplySender(object):
+	"""Rate aware outbound reply scheduler drained by a bounded pool of workers.
+
+	`send` is either a coroutine function, awaited on the loop, or the blocking
+	instagrapi call, run in a thread pool so the MQTT event loop keeps
+	processing packets while a reply is in flight. Only coroutine sends run
+	concurrently, the instagrapi client handles one request at a time.
+
+	Replies are buffered per thread for `coalesce_window` seconds and sent as
+	a single message, at most once every `thread_interval` seconds per thread
+	and within the account wide `rate`/`burst` token bucket.
+
+	Every reply has a priority (PUN, COMMAND, WELCOME, DEBUG) with a lane
+	set of its own, puns get `workers` lanes and the others one each, so a
+	welcome waiting for the rate budget never holds a pun back, and puns
+	take the next token first. A reply still waiting past the deadline of
+	its priority (`max_age` for puns, `deadlines` for the others) is dropped,
+	a late pun is no pun. Every thread id is pinned to one lane of each
+	priority, so replies of a priority to a given thread are sent in the
+	order they were queued while different threads go out concurrently.
+	"""
+
+	def __init__(self, send, workers=4, max_queue=256, executor=None,
+			rate=0.5, burst=5, thread_interval=1.0, coalesce_window=0.3, max_age=10.0, deadlines=None):
+		self.send = send
+		self.workers = max(1, workers)
+		self.max_queue = max_queue
+		self.executor = executor or ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="reply")
+
+		self.bucket = TokenBucket(rate, burst)
+		# Blocking sends go through one instagrapi client, one at a time
+		self._send_lock = contextlib.nullcontext() if asyncio.iscoroutinefunction(send) else asyncio.Lock()
+		self.thread_interval = thread_interval
+		self.coalesce_window = coalesce_window
+		self.deadlines = {**DEADLINES, **(deadlines or {}), PUN: max_age}
+
+		self.sent = 0
+		self.failed = 0
+		self.dropped = 0
+		self.stale = 0
+		self.coalesced = 0
+
+		self._pending = 0
+		self._queued = Counter() # priority -> replies buffered, not taken by a lane yet
+		self._buffers = {} # (priority, thread_id) -> [(text, deadline), ..]
+		self._scheduled = set()
+		self._last_sent = {} # thread_id -> monotonic time of last send
+		self._lanes = {} # priority -> [Queue, ..]
+		self._tasks = []
+
+	@property
+	def running(self):
+		return bool(self._tasks)
+
+	@property
+	def depth(self):
+		return self._pending
+
+	def start(self):
+		if self.running:
+			return
+
+		self._lanes = {
+			priority: [asyncio.Queue() for _ in range(self.workers if priority == PUN else 1)]
+			for priority in DEADLINES
+		}
+		self._tasks = [
+			asyncio.ensure_future(self._worker(lane, priority))
+			for priority, lanes in self._lanes.items() for lane in lanes
+		]
+
+	async def stop(self, drain=True, timeout=10.0):
+		"""Wait up to `timeout` seconds for the queued replies to leave, then drop the rest"""
+		if not self.running:
+			return
+
+		deadline = time.monotonic() + timeout
+		while drain and self._pending and time.monotonic() < deadline:
+			await asyncio.sleep(0.05)
+
+		if self._pending:
+			logging.warning(f"Stopping with {self._pending} replies still queued, dropped")
+
+		for task in self._tasks:
+			task.cancel()
+		await asyncio.gather(*self._tasks, return_exceptions=True)
+
+		self._tasks = []
+		self._lanes = {}
+		self._buffers.clear()
+		self._scheduled.clear()
+		self._queued.clear()
+		self._pending = 0
+
+	def _lane(self, key):
+		priority, thread_id = key
+		lanes = self._lanes[priority]
+		return lanes[hash(thread_id) % len(lanes)]
+
+	def _schedule(self, key, delay):
+		self._scheduled.add(key)
+		asyncio.get_event_loop().call_later(delay, self._ready, key)
+
+	def _ready(self, key):
+		if self.running:
+			self._lane(key).put_nowait(key)
+
+	def submit(self, text, thread_id, priority=PUN):
+		"""Queue a reply, returns False when it was dropped because the queue is full or the sender stopped"""
+		if not self.running:
+			self.dropped += 1
+			REPLIES.inc(PRIORITY_NAMES[priority], 'dropped')
+			return False
+
+		QUEUE_DEPTH.observe(self._pending)
+		if self._pending >= self.max_queue:
+			self.dropped += 1
+			REPLIES.inc(PRIORITY_NAMES[priority], 'dropped')
+			logging.warning(f"Reply queue full ({self._pending}), dropping {PRIORITY_NAMES[priority]} reply to {thread_id}")
+			return False
+
+		key = (priority, thread_id)
+		self._pending += 1
+		self._queued[priority] += 1
+		self._buffers.setdefault(key, []).append((text, time.monotonic() + self.deadlines[priority]))
+
+		if key not in self._scheduled:
+			self._schedule(key, self.coalesce_window)
+
+		return True
+
+	def _drop_stale(self, key):
+		"""Forget the replies of `key` past their deadline, returns how many are left"""
+		items = self._buffers.get(key, [])
+		now = time.monotonic()
+		fresh = [item for item in items if item[1] >= now]
+
+		stale = len(items) - len(fresh)
+		if stale:
+			self.stale += stale
+			self._pending -= stale
+			self._queued[key[0]] -= stale
+			REPLIES.inc(PRIORITY_NAMES[key[0]], 'stale', amount=stale)
+
+		if fresh:
+			self._buffers[key] = fresh
+		else:
+			self._buffers.pop(key, None)
+			self._scheduled.discard(key)
+		return len(fresh)
+
+	def _take(self, key):
+		self._drop_stale(key)
+		items = self._buffers.pop(key, [])
+		self._scheduled.discard(key)
+		self._queued[key[0]] -= len(items)
+
+		texts = [text for text, _ in items]
+		self.coalesced += max(0, len(texts) - 1)
+
+		return len(items), texts
+
+	def _forget_idle_threads(self):
+		now = time.monotonic()
+		for thread_id, last in list(self._last_sent.items()):
+			if now - last > self.thread_interval:
+				del self._last_sent[thread_id]
+
+	async def _worker(self, lane, priority):
+		name = PRIORITY_NAMES[priority]
+
+		while True:
+			key = await lane.get()
+			thread_id = key[1]
+			taken = 0
+			try:
+				wait = self._last_sent.get(thread_id, 0) + self.thread_interval - time.monotonic()
+				if wait > 0:
+					# Too soon for this thread, keep buffering and come back later
+					self._schedule(key, wait)
+					continue
+
+				while any(self._queued[urgent] for urgent in range(priority)):
+					# More urgent replies are still queued, maybe behind a busy lane
+					await asyncio.sleep(0.05)
+
+				# Expired replies are dropped before they cost a token
+				if not self._drop_stale(key):
+					continue
+
+				await self.bucket.acquire(priority)
+
+				taken, texts = self._take(key)
+				if not texts:
+					# All expired while waiting for the token
+					self.bucket.refund()
+					continue
+
+				self._last_sent[thread_id] = time.monotonic()
+				if len(self._last_sent) > 1024:
+					self._forget_idle_threads()
+
+				with SEND_SECONDS.time():
+					async with self._send_lock:
+						await call(self.executor, self.send, "\n".join(texts), thread_ids=[thread_id])
+				self.sent += 1
+				REPLIES.inc(name, 'sent')
+
+			except Exception as e:
+				self.failed += 1
+				REPLIES.inc(name, 'failed')
+				logging.error(f"Could not send reply to {thread_id}: {e!r}")
+
+			finally:
+				# Only count replies as done once they left, so stop() can drain in-flight sends
+				self._pending -= taken
+				lane.task_done()
+
+	@property
+	def metrics(self):
+		return {
+			"queue_depth": self._pending,
+			"sent": self.sent,
+			"failed": self.failed,
+			"dropped": self.dropped,
+			"stale": self.stale,
+			"coalesced": self.coalesced
+		}
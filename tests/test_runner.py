@@ -0,0 +1,33 @@
+from urllib3.util.retry import Retry
+
+from app import ExtendedClient
+from runner import MultiAccountRunner
+
+
+def test_shared_adapters_keep_instagrapi_retries():
+	runner = MultiAccountRunner(None, [])
+	client = ExtendedClient(private_transport="requests")
+	client.share_http_adapters(runner.http_adapters)
+
+	for name, session in (('private', client.private), ('public', client.public)):
+		adapter = session.get_adapter('https://i.instagram.com/api/v1/')
+		assert adapter is runner.http_adapters[name]
+		assert isinstance(adapter.max_retries, Retry)
+		assert adapter.max_retries.total == client.session_retry_total
+		assert adapter.max_retries.backoff_factor == client.session_retry_backoff_factor
+		assert set(adapter.max_retries.status_forcelist) == set(client.session_retry_statuses)
+
+	# The private API is retried on POST too
+	assert 'POST' in runner.http_adapters['private'].max_retries.allowed_methods
+	runner.executor.shutdown(wait=False)
+
+
+def test_curl_transport_is_left_mounted():
+	runner = MultiAccountRunner(None, [])
+	client = ExtendedClient(private_transport="curl")
+	curl = client.private.get_adapter('https://i.instagram.com/api/v1/')
+	client.share_http_adapters(runner.http_adapters)
+
+	assert client.private.get_adapter('https://i.instagram.com/api/v1/') is curl
+	assert client.public.get_adapter('https://www.instagram.com/') is runner.http_adapters['public']
+	runner.executor.shutdown(wait=False)